@@ -8,44 +8,86 @@ from copy import deepcopy
 from geoalchemy2 import shape
 from shapely import wkt, geometry
 from shapely.ops import linemerge
-from sqlalchemy import create_engine, and_
+from sqlalchemy import create_engine, and_, not_, func
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import NullPool
 
-from . import preprocess
-from .gazetteer import ContainmentGazetteer, ProximalGazetteer
+from . import benchmark, jobs, preprocess
+from .gazetteer import ContainmentGazetteer, ProximalGazetteer, make_point
 from .filters import ContainmentFilter, ProximalFilter, type_match
 from .classifier import (NameSalienceCalculator, TypeSalienceCalculator,
                          FlickrSalienceCalculator, UrbanRuralClassifier)
-from .models import LookupCache, Polygon, Line, Point, setup_db
+from .instrumentation import Instrumentation, LoggingSink
+from .statements import PreparedStatements
+from .models import (LookupCache, SpatialLookupCache, Polygon, Toponym, load_geometries,
+                     setup_db)
+
+
+PROFILES = ['containment', 'proximal', 'full']
+
+
+def cache_key(point, profile='full'):
+    """Return the lookup cache key for the point and profile."""
+    if profile == 'full':
+        return '%.5f::%.5f' % point
+    return '%.5f::%.5f::%s' % (point[0], point[1], profile)
 
 
 class OSMGaz(object):
     """Main interface object, handles the full gazetteer pipeline.
+
+    The lookup results are cached either by the exact point (``cache='point'``) or
+    spatially (``cache='spatial'``). The spatial cache re-uses the containment
+    toponyms for any point within the same containment cell and the proximal toponyms
+    for any point within ``cache_tolerance`` meters of a cached point. The containment
+    cells are limited to a square of ``cache_cell_size`` meters around the cached point.
+
+    If ``instrument`` is set, then the per-stage timings, SQL statement counts, and
+    cache hits are recorded for each lookup, passed to the ``metrics_sink`` and
+    attached to the result as ``osm_metrics``.
+
+    If ``top_k`` is set, then the proximal search only retrieves the ``top_k`` nearest
+    toponyms per feature table within ``max_distance`` meters.
+
+    If ``prepared`` is set, then the containment, proximal, and salience queries are run
+    as server-side prepared statements on pooled connections.
     """
 
-    def __init__(self, sqlalchemy_uri, callback=None):
-        engine = create_engine(sqlalchemy_uri, poolclass=NullPool)
+    def __init__(self, sqlalchemy_uri, callback=None, cache='point', cache_tolerance=25,
+                 instrument=False, metrics_sink=None, top_k=None, max_distance=3000,
+                 prepared=False, cache_cell_size=500):
+        if prepared:
+            engine = create_engine(sqlalchemy_uri)
+            statements = PreparedStatements()
+        else:
+            engine = create_engine(sqlalchemy_uri, poolclass=NullPool)
+            statements = None
         Session = sessionmaker(bind=engine)
         self.session = Session()
-        self.containment_gaz = ContainmentGazetteer(self.session)
+        self.instrumentation = Instrumentation(engine, enabled=instrument, sink=metrics_sink)
+        self.containment_gaz = ContainmentGazetteer(self.session, statements=statements)
         self.containment_filter = ContainmentFilter(self.containment_gaz)
-        self.proximal_gaz = ProximalGazetteer(self.session)
+        self.proximal_gaz = ProximalGazetteer(self.session, top_k=top_k, max_distance=max_distance,
+                                              statements=statements)
         self.proximal_filter = ProximalFilter(self.proximal_gaz)
-        self.name_salience_calculator = NameSalienceCalculator(self.session)
-        self.type_salience_calculator = TypeSalienceCalculator(self.session)
-        self.flickr_salience_calculator = FlickrSalienceCalculator(self.session)
-        self.urban_rural_classifier = UrbanRuralClassifier()
+        self.name_salience_calculator = NameSalienceCalculator(self.session, self.instrumentation, statements)
+        self.type_salience_calculator = TypeSalienceCalculator(self.session, self.instrumentation, statements)
+        self.flickr_salience_calculator = FlickrSalienceCalculator(self.session, self.instrumentation)
+        self.urban_rural_classifier = UrbanRuralClassifier(self.session)
         self.callback = callback
+        self.cache = cache
+        self.cache_tolerance = cache_tolerance
+        self.cache_cell_size = cache_cell_size
 
-    def load(self, point):
-        cache = self.session.query(LookupCache).filter(LookupCache.point == '%.5f::%.5f' % point).first()
+    def load(self, point, profile='full'):
+        cache = self.session.query(LookupCache).filter(LookupCache.point == cache_key(point, profile)).first()
+        self.instrumentation.cache('lookup_cache', cache is not None)
         if cache:
             data = json.loads(cache.data)
             return data
         return None
     
-    def save(self, point, data):
+    def save(self, point, data, profile='full'):
         data = deepcopy(data)
         for toponym in data['osm_containment']:
             if 'osm_salience' in toponym:
@@ -53,39 +95,100 @@ class OSMGaz(object):
                     toponym['osm_salience']['name'] = float(toponym['osm_salience']['name'])
                 if 'type' in toponym['osm_salience']:
                     toponym['osm_salience']['type'] = float(toponym['osm_salience']['type'])
-        for toponym in data['osm_proximal']:
+        for toponym in data.get('osm_proximal', []):
             if 'osm_salience' in toponym:
                 if 'name' in toponym['osm_salience']:
                     toponym['osm_salience']['name'] = float(toponym['osm_salience']['name'])
                 if 'type' in toponym['osm_salience']:
                     toponym['osm_salience']['type'] = float(toponym['osm_salience']['type'])
-        self.session.add(LookupCache(point='%.5f::%.5f' % point,
+        self.session.add(LookupCache(point=cache_key(point, profile),
+                                     location=make_point(self.containment_gaz.proj(*point)),
                                      data=json.dumps(data)))
         self.session.commit()
+
+    def load_spatial(self, point):
+        """Find the spatial cache entry nearest to the point whose containment cell
+        contains the point. Returns the entry and a flag whether the cached proximal
+        toponyms are within the tolerance and can be re-used.
+        """
+        coords = self.containment_gaz.proj(*point)
+        point = make_point(coords)
+        cache = self.session.query(SpatialLookupCache).filter(SpatialLookupCache.cell.ST_Contains(point)).\
+            order_by(SpatialLookupCache.point.distance_centroid(point)).first()
+        self.instrumentation.cache('spatial_lookup_cache', cache is not None)
+        if cache:
+            distance = shape.to_shape(cache.point).distance(geometry.Point(*coords))
+            return cache, distance <= self.cache_tolerance
+        return None, False
+
+    def save_spatial(self, point, containment, filtered_containment, urban_rural, data, cell=None):
+        """Store the lookup results in the spatial cache. If no containment cell is
+        given, then it is calculated from the containment toponyms.
+        """
+        if not filtered_containment:
+            return
+        coords = self.containment_gaz.proj(*point)
+        point = make_point(coords)
+        if cell is None:
+            cell = self.containment_cell(point, containment)
+        self.session.add(SpatialLookupCache(point=point,
+                                            cell=cell,
+                                            containment=json.dumps({'containment': [t.gid for t, _ in containment],
+                                                                    'filtered_containment': [t.gid for t, _ in filtered_containment],
+                                                                    'urban_rural': urban_rural,
+                                                                    'data': data['osm_containment']}),
+                                            proximal=json.dumps(data['osm_proximal'])))
+        self.session.commit()
+
+    def containment_cell(self, point, containment):
+        """Calculate the area around the point in which the containment hierarchy is
+        identical: the intersection of all containers, minus all named polygons that do
+        not contain the point. The cell is clipped to a square of cache_cell_size
+        meters around the point, so that only the polygons near the point are
+        subtracted.
+        """
+        cell = self.session.query(func.ST_Intersection(Polygon.way,
+                                                       func.ST_Expand(point, self.cache_cell_size / 2))).\
+            filter(Polygon.gid == containment[0][0].gid).scalar()
+        for toponym, _ in containment[1:]:
+            if not self.session.query(Polygon.way.ST_Covers(cell)).filter(Polygon.gid == toponym.gid).scalar():
+                cell = self.session.query(func.ST_Intersection(Polygon.way, cell)).filter(Polygon.gid == toponym.gid).scalar()
+        holes = self.session.query(func.ST_Union(Polygon.way)).filter(and_(Polygon.name != '',
+                                                                           Polygon.way.ST_Intersects(cell),
+                                                                           not_(Polygon.way.ST_Contains(point)))).scalar()
+        if holes is not None:
+            cell = self.session.query(func.ST_Difference(cell, holes)).scalar()
+        return cell
+
+    def load_containers(self, gids):
+        """Re-load the containment toponyms with the given gids, in the order of the gids."""
+        containers = dict([(t.gid, (t, c)) for (t, c) in self.containment_gaz.query(Polygon, Polygon.gid.in_(gids))])
+        return [containers[gid] for gid in gids if gid in containers]
     
     def merge_lines(self, toponyms):
         """Merge all line toponyms with the same name together."""
         result = []
         processed = []
         for idx, (toponym1, classification) in enumerate(toponyms):
-            if isinstance(toponym1, Polygon) or isinstance(toponym1, Point):
+            if toponym1.category != 'Line':
                 result.append((toponym1, classification))
                 continue
             if toponym1.osm_id in processed:
                 continue
             geometries = [shape.to_shape(toponym1.way)]
             for toponym2, _ in toponyms[idx + 1:]:
-                if isinstance(toponym2, Polygon) or isinstance(toponym2, Point):
+                if toponym2.category != 'Line':
                     continue
                 if toponym1.name == toponym2.name:
                     geometries.append(shape.to_shape(toponym2.way))
                     processed.append(toponym2.osm_id)
             if len(geometries) > 1:
-                merged_toponym = Line(gid=toponym1.gid,
-                                      osm_id=toponym1.osm_id,
-                                      name=toponym1.name,
-                                      way=shape.from_shape(linemerge(geometries), 900913),
-                                      tags=toponym1.tags)
+                merged_toponym = Toponym('Line',
+                                         toponym1.gid,
+                                         toponym1.osm_id,
+                                         toponym1.name,
+                                         classification=toponym1.classification,
+                                         way=shape.from_shape(linemerge(geometries), 900913))
                 result.append((merged_toponym, classification))
             else:
                 result.append((toponym1, classification))
@@ -96,7 +199,7 @@ class OSMGaz(object):
         processed = []
         junctions = []
         for idx, (toponym1, classification1) in enumerate(toponyms):
-            if isinstance(toponym1, Polygon) or isinstance(toponym1, Point) or not type_match(classification1['type'], ['ARTIFICIAL FEATURE', 'TRANSPORT', 'ROAD']):
+            if toponym1.category != 'Line' or not type_match(classification1['type'], ['ARTIFICIAL FEATURE', 'TRANSPORT', 'ROAD']):
                 continue
             for toponym2, classification2 in toponyms[idx + 1:]:
                 if (toponym1.osm_id, toponym2.osm_id) in processed or (toponym2.osm_id, toponym1.osm_id) in processed or not type_match(classification2['type'], ['ARTIFICIAL FEATURE', 'TRANSPORT', 'ROAD']):
@@ -108,69 +211,230 @@ class OSMGaz(object):
                     geom = geom1.intersection(geom2)
                     if isinstance(geom, geometry.MultiPoint):
                         for part in geom:
-                            junctions.append((Point(gid=-toponym1.gid,
-                                                    osm_id=-toponym1.osm_id,
-                                                    name='%s and %s' % (toponym1.name, toponym2.name),
-                                                    way=shape.from_shape(part, 900913)),
+                            junctions.append((Toponym('Point',
+                                                      -toponym1.gid,
+                                                      -toponym1.osm_id,
+                                                      '%s and %s' % (toponym1.name, toponym2.name),
+                                                      way=shape.from_shape(part, 900913)),
                                               {'type': ['ARTIFICIAL FEATURE', 'TRANSPORT', 'ROAD', 'JUNCTION']}))
                     else:
-                        junctions.append((Point(gid=-toponym1.gid,
-                                                osm_id=-toponym1.osm_id,
-                                                name='%s and %s' % (toponym1.name, toponym2.name),
-                                                way=shape.from_shape(geom, 900913)),
+                        junctions.append((Toponym('Point',
+                                                  -toponym1.gid,
+                                                  -toponym1.osm_id,
+                                                  '%s and %s' % (toponym1.name, toponym2.name),
+                                                  way=shape.from_shape(geom, 900913)),
                                           {'type': ['ARTIFICIAL FEATURE', 'TRANSPORT', 'ROAD', 'JUNCTION']}))
         toponyms.extend(junctions)
         return toponyms
 
-    def __call__(self, point):
+    def find_containment(self, point):
+        """Retrieve the containment toponyms and the filtered containment hierarchy."""
+        if self.callback is not None:
+            self.callback('Finding containment toponyms')
+        with self.instrumentation.stage('containment'):
+            containment = self.containment_gaz(point)
+        with self.instrumentation.stage('containment_filter'):
+            filtered_containment = self.containment_filter(containment)
+        with self.instrumentation.stage('geometry'):
+            load_geometries(self.session, filtered_containment)
+        return containment, filtered_containment
+
+    def find_proximal(self, point, containment, filtered_containment):
+        """Retrieve the filtered proximal toponyms and the urban/rural classification."""
+        if self.callback is not None:
+            self.callback('Finding proximal toponyms')
+        with self.instrumentation.stage('urban_rural'):
+            urban_rural = self.urban_rural_classifier(point)
+        with self.instrumentation.stage('proximal'):
+            proximal = self.proximal_gaz(point, containment, urban_rural)
+        if urban_rural is None:
+            with self.instrumentation.stage('urban_rural'):
+                buildings = [(t, c) for (t, c) in containment if type_match(c['type'], ['ARTIFICIAL FEATURE', 'BUILDING'])]
+                urban_rural = self.urban_rural_classifier(point, proximal + buildings)
+        with self.instrumentation.stage('proximal_filter'):
+            filtered_proximal = self.proximal_filter(proximal, point, containment, urban_rural)
+        with self.instrumentation.stage('geometry'):
+            load_geometries(self.session, filtered_proximal)
+        with self.instrumentation.stage('merge_lines'):
+            filtered_proximal = self.merge_lines(filtered_proximal)
+        with self.instrumentation.stage('add_intersections'):
+            filtered_proximal = self.add_intersections(filtered_proximal)
+        return filtered_proximal, urban_rural
+
+    def format_topo(self, toponym, classification, name_salience=None, type_salience=None, flickr_salience=None):
+        data = {'dc_title': toponym.name,
+                'osm_geometry': wkt.dumps(shape.to_shape(toponym.way)),
+                'dc_type': classification['type']}
+        if name_salience is not None or type_salience is not None or flickr_salience is not None:
+            data['osm_salience'] = {}
+            if name_salience is not None:
+                data['osm_salience']['name'] = float(name_salience)  # Todo: Remove float() call when the JSON serialiser can handle Decimals
+            if type_salience is not None:
+                data['osm_salience']['type'] = float(type_salience)
+            if flickr_salience is not None:
+                data['osm_salience']['flickr'] = float(flickr_salience)
+        return data
+
+    def format_containment(self, filtered_containment, urban_rural):
+        """Format the containment toponyms, calculating the salience for buildings."""
+        with self.instrumentation.stage('salience'):
+            return [self.format_topo(t,
+                                     c,
+                                     self.name_salience_calculator(t, c, filtered_containment[1:]) if type_match(c['type'], ['ARTIFICIAL FEATURE', 'BUILDING']) else None,
+                                     self.type_salience_calculator(c, filtered_containment[1:]) if type_match(c['type'], ['ARTIFICIAL FEATURE', 'BUILDING']) else None,
+                                     self.flickr_salience_calculator(t, c, urban_rural) if type_match(c['type'], ['ARTIFICIAL FEATURE', 'BUILDING']) else None) for (t, c) in filtered_containment]
+
+    def format_proximal(self, filtered_proximal, filtered_containment, urban_rural):
+        """Format the proximal toponyms, calculating the salience for all non-junctions."""
+        with self.instrumentation.stage('salience'):
+            return [self.format_topo(t,
+                                     c,
+                                     self.name_salience_calculator(t, c, filtered_containment) if not type_match(c['type'], ['ARTIFICIAL FEATURE', 'TRANSPORT', 'ROAD', 'JUNCTION']) else 1,
+                                     self.type_salience_calculator(c, filtered_containment) if not type_match(c['type'], ['ARTIFICIAL FEATURE', 'TRANSPORT', 'ROAD', 'JUNCTION']) else 0,
+                                     self.flickr_salience_calculator(t, c, urban_rural) if not type_match(c['type'], ['ARTIFICIAL FEATURE', 'TRANSPORT', 'ROAD', 'JUNCTION']) else 0)
+                    for (t, c) in filtered_proximal]
+
+    def spatial_pipeline(self, point, progressive=False):
+        """Generator that runs the full pipeline using the spatial cache. The last result
+        is the complete result. If progressive is set, then the partial results are also
+        yielded, as for :meth:`pipeline`."""
+        with self.instrumentation.stage('cache'):
+            cache, proximal_hit = self.load_spatial(point)
+        if cache:
+            cached_containment = json.loads(cache.containment)
+            if proximal_hit:
+                if self.callback is not None:
+                    self.callback('Loading geo-data from cache')
+                yield {'osm_containment': cached_containment['data'],
+                       'osm_proximal': json.loads(cache.proximal)}
+                return
+            if self.callback is not None:
+                self.callback('Loading containment geo-data from cache')
+            if progressive:
+                yield {'osm_containment': cached_containment['data']}
+            with self.instrumentation.stage('cache'):
+                containment = self.load_containers(cached_containment['containment'])
+                filtered_containment = self.load_containers(cached_containment['filtered_containment'])
+            filtered_proximal, urban_rural = self.find_proximal(point, containment, filtered_containment)
+            if progressive:
+                yield {'osm_containment': cached_containment['data'],
+                       'osm_proximal': [self.format_topo(t, c) for (t, c) in filtered_proximal]}
+            if self.callback is not None:
+                self.callback('Calculating toponym salience')
+            data = {'osm_containment': cached_containment['data'],
+                    'osm_proximal': self.format_proximal(filtered_proximal, filtered_containment, urban_rural)}
+            with self.instrumentation.stage('cache'):
+                self.save_spatial(point, containment, filtered_containment, urban_rural, data, cell=cache.cell)
+            yield data
+            return
+        containment, filtered_containment = self.find_containment(point)
+        if progressive:
+            yield {'osm_containment': [self.format_topo(t, c) for (t, c) in filtered_containment]}
+        filtered_proximal, urban_rural = self.find_proximal(point, containment, filtered_containment)
+        if progressive:
+            yield {'osm_containment': [self.format_topo(t, c) for (t, c) in filtered_containment],
+                   'osm_proximal': [self.format_topo(t, c) for (t, c) in filtered_proximal]}
+        if self.callback is not None:
+            self.callback('Calculating toponym salience')
+        data = {'osm_containment': self.format_containment(filtered_containment, urban_rural),
+                'osm_proximal': self.format_proximal(filtered_proximal, filtered_containment, urban_rural)}
+        with self.instrumentation.stage('cache'):
+            self.save_spatial(point, containment, filtered_containment, urban_rural, data)
+        yield data
+
+    def lookup_spatial(self, point):
+        """Run the gazetteer pipeline using the spatial cache."""
+        for data in self.spatial_pipeline(point):
+            pass
+        return data
+
+    def pipeline(self, point, profile='full', progressive=False):
+        """Generator that runs the pipeline stages needed for the profile. The last
+        result is the complete result for the profile. If progressive is set, then the
+        partial results are also yielded: first the containment toponyms, then also the
+        proximal toponyms, both without salience.
+        """
+        containment, filtered_containment = self.find_containment(point)
+        if progressive or profile == 'containment':
+            data = {'osm_containment': [self.format_topo(t, c) for (t, c) in filtered_containment]}
+            yield dict(data)
+        if profile == 'containment':
+            return
+        filtered_proximal, urban_rural = self.find_proximal(point, containment, filtered_containment)
+        if progressive or profile == 'proximal':
+            data = {'osm_containment': [self.format_topo(t, c) for (t, c) in filtered_containment],
+                    'osm_proximal': [self.format_topo(t, c) for (t, c) in filtered_proximal]}
+            yield dict(data)
+        if profile == 'proximal':
+            return
+        if self.callback is not None:
+            self.callback('Calculating toponym salience')
+        yield {'osm_containment': self.format_containment(filtered_containment, urban_rural),
+               'osm_proximal': self.format_proximal(filtered_proximal, filtered_containment, urban_rural)}
+
+    def __call__(self, point, profile='full'):
         """Run the gazetteer pipeline for a single point. Returns a dictionary with
         containment and proximal toponyms. The containment toponyms are sorted by
         containment hierarchy. The proximal toponyms are in a random order.
+
+        The profile determines which stages are run: 'containment' only finds the
+        containment toponyms, 'proximal' finds both containment and proximal toponyms
+        without calculating their salience, and 'full' runs the complete pipeline.
         """
-        def format_topo(toponym, classification, name_salience=None, type_salience=None, flickr_salience=None):
-            data = {'dc_title': toponym.name,
-                    'osm_geometry': wkt.dumps(shape.to_shape(toponym.way)),
-                    'dc_type': classification['type']}
-            if name_salience is not None or type_salience is not None or flickr_salience is not None:
-                data['osm_salience'] = {}
-                if name_salience is not None:
-                    data['osm_salience']['name'] = float(name_salience)  # Todo: Remove float() call when the JSON serialiser can handle Decimals
-                if type_salience is not None:
-                    data['osm_salience']['type'] = float(type_salience)
-                if flickr_salience is not None:
-                    data['osm_salience']['flickr'] = float(flickr_salience)
-            return data
-        cache = self.load(point)
+        self.instrumentation.start()
+        data = self.lookup(point, profile)
+        metrics = self.instrumentation.finish()
+        if metrics is not None:
+            data['osm_metrics'] = metrics
+        return data
+
+    def progressive(self, point, profile='full'):
+        """Run the gazetteer pipeline for a single point, yielding the results as they
+        become available: first the containment toponyms, then the proximal toponyms,
+        and finally (for the 'full' profile) both with their salience. Cached results
+        are yielded at once.
+        """
+        self.instrumentation.start()
+        if self.cache == 'spatial' and profile == 'full':
+            data = None
+            for partial in self.spatial_pipeline(point, progressive=True):
+                if data is not None:
+                    yield data
+                data = partial
+        else:
+            with self.instrumentation.stage('cache'):
+                data = self.load(point, profile)
+            if data:
+                if self.callback is not None:
+                    self.callback('Loading geo-data from cache')
+            else:
+                stages = PROFILES.index(profile) + 1
+                for idx, data in enumerate(self.pipeline(point, profile, progressive=True)):
+                    if idx + 1 < stages:
+                        yield data
+                with self.instrumentation.stage('cache'):
+                    self.save(point, data, profile)
+        metrics = self.instrumentation.finish()
+        if metrics is not None:
+            data['osm_metrics'] = metrics
+        yield data
+
+    def lookup(self, point, profile='full'):
+        """Run the gazetteer pipeline, using the configured cache. The spatial cache is
+        only used for the 'full' profile."""
+        if self.cache == 'spatial' and profile == 'full':
+            return self.lookup_spatial(point)
+        with self.instrumentation.stage('cache'):
+            cache = self.load(point, profile)
         if cache:
             if self.callback is not None:
                 self.callback('Loading geo-data from cache')
             return cache
         else:
-            if self.callback is not None:
-                self.callback('Finding containment toponyms')
-            containment = self.containment_gaz(point)
-            filtered_containment = self.containment_filter(containment)
-            if self.callback is not None:
-                self.callback('Finding proximal toponyms')
-            proximal = self.proximal_gaz(point, filtered_containment)
-            urban_rural = self.urban_rural_classifier(point, proximal)
-            filtered_proximal = self.proximal_filter(proximal, point, containment, urban_rural)
-            filtered_proximal = self.merge_lines(filtered_proximal)
-            filtered_proximal = self.add_intersections(filtered_proximal)
-            if self.callback is not None:
-                self.callback('Calculating toponym salience')
-            data = {'osm_containment': [format_topo(t,
-                                                    c,
-                                                    self.name_salience_calculator(t, c, filtered_containment[1:]) if type_match(c['type'], ['ARTIFICIAL FEATURE', 'BUILDING']) else None,
-                                                    self.type_salience_calculator(c, filtered_containment[1:]) if type_match(c['type'], ['ARTIFICIAL FEATURE', 'BUILDING']) else None,
-                                                    self.flickr_salience_calculator(t, c, urban_rural) if type_match(c['type'], ['ARTIFICIAL FEATURE', 'BUILDING']) else None) for (t, c) in filtered_containment],
-                    'osm_proximal': [format_topo(t,
-                                                 c,
-                                                 self.name_salience_calculator(t, c, filtered_containment) if not type_match(c['type'], ['ARTIFICIAL FEATURE', 'TRANSPORT', 'ROAD', 'JUNCTION']) else 1,
-                                                 self.type_salience_calculator(c, filtered_containment) if not type_match(c['type'], ['ARTIFICIAL FEATURE', 'TRANSPORT', 'ROAD', 'JUNCTION']) else 0,
-                                                 self.flickr_salience_calculator(t, c, urban_rural) if not type_match(c['type'], ['ARTIFICIAL FEATURE', 'TRANSPORT', 'ROAD', 'JUNCTION']) else 0)
-                                     for (t, c) in filtered_proximal]}
-            self.save(point, data)
+            for data in self.pipeline(point, profile):
+                pass
+            with self.instrumentation.stage('cache'):
+                self.save(point, data, profile)
             return data
 
 
@@ -184,20 +448,40 @@ def test(args):
               (-2.04045, 53.34058), # Lyme Park
               (-2.47429, 53.3827),  # Lymm
               ]
-    gaz = OSMGaz(args.sqla_url)
+    gaz = OSMGaz(args.sqla_url, cache=args.cache, instrument=args.metrics,
+                 metrics_sink=LoggingSink() if args.metrics else None, top_k=args.top_k,
+                 prepared=args.prepared, cache_tolerance=args.cache_tolerance)
     for point in points:
         print(point)
-        data = gaz(point)
+        data = gaz(point, args.profile)
         print(', '.join([t['dc_title'] for t in data['osm_containment']]))
         #print('\n'.join(['%s - %s (%.4f %.4f)' % (t['dc_title'], t['dc_type'], t['osm_salience']['name'], t['osm_salience']['type']) for t in data['osm_proximal']]))
-        print('\n'.join(['%s (%.4f %.4f %i)' % (t['dc_title'], t['osm_salience']['name'], t['osm_salience']['type'], t['osm_salience']['flickr']) for t in data['osm_proximal']]))
+        if args.profile == 'full':
+            print('\n'.join(['%s (%.4f %.4f %i)' % (t['dc_title'], t['osm_salience']['name'], t['osm_salience']['type'], t['osm_salience']['flickr']) for t in data['osm_proximal']]))
+        elif args.profile == 'proximal':
+            print('\n'.join([t['dc_title'] for t in data['osm_proximal']]))
 
 
 def main():
     parser = ArgumentParser()
-    parser.add_argument('action', choices=['setup-db', 'pre-process', 'test'])
+    parser.add_argument('action', choices=['setup-db', 'pre-process', 'update', 'test', 'benchmark',
+                                           'enqueue', 'worker'])
     parser.add_argument('sqla_url')
     parser.add_argument('--full', default=False, action='store_true')
+    parser.add_argument('--changes', default='changes.txt')
+    parser.add_argument('--cache', choices=['point', 'spatial'], default='point')
+    parser.add_argument('--cache-tolerance', default=25, type=float)
+    parser.add_argument('--metrics', default=False, action='store_true')
+    parser.add_argument('--top-k', default=None, type=int)
+    parser.add_argument('--prepared', default=False, action='store_true')
+    parser.add_argument('--profile', choices=PROFILES, default='full')
+    parser.add_argument('--generate', default=False, action='store_true')
+    parser.add_argument('--points', default=100, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--input', default='points.txt')
+    parser.add_argument('--batch-size', default=100, type=int)
+    parser.add_argument('--wait', default=False, action='store_true')
     args = parser.parse_args()
     if args.action == 'setup-db':
         setup_db(args)
@@ -205,4 +489,12 @@ def main():
         test(args)
     elif args.action == 'pre-process':
         preprocess.run(args)
+    elif args.action == 'update':
+        preprocess.update(args)
+    elif args.action == 'benchmark':
+        benchmark.run(args)
+    elif args.action == 'enqueue':
+        jobs.run_enqueue(args)
+    elif args.action == 'worker':
+        jobs.run_worker(args)
 
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Contains the benchmark suite. Generates a synthetic, OSM-shaped data-set and measures
+the lookup latency, classifier throughput, and pre-processing throughput.
+
+The synthetic data-set consists of nested administrative polygons, a dense grid of
+road segments with buildings in each block, POIs with realistic hstore tags in the
+town, and sparse rural POIs. It is loaded into an empty PostGIS database.
+
+The benchmark deletes the lookup and salience caches and re-classifies all features,
+thus it only runs on a database that contains the marker table written by the
+generator. The generator only replaces the OSM tables of an empty database or of a
+previously generated data-set.
+
+.. moduleauthor:: Mark Hall <mark.hall@mail.room3b.eu>
+"""
+import json
+import logging
+import random
+import sys
+import time
+
+from collections import namedtuple
+from contextlib import redirect_stdout
+from geoalchemy2 import WKTElement
+from numpy import percentile
+from pyproj import Proj
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from osmgaz import preprocess
+from osmgaz.classifier import ToponymClassifier
+from osmgaz.filters import ContainmentFilter
+from osmgaz.gazetteer import ContainmentGazetteer
+from osmgaz.models import (Polygon, Line, Point, NameSalienceCache, TypeSalienceCache, LookupCache,
+                           SpatialLookupCache, setup_db)
+
+SyntheticToponym = namedtuple('SyntheticToponym', ['name', 'tags'])
+GenerateArgs = namedtuple('GenerateArgs', ['sqla_url'])
+
+ORIGIN = (-2.6, 53.4)
+COUNTRY_SIZE = 80000
+BLOCK_SIZE = 100
+POI_TAGS = [{'amenity': 'pub'},
+            {'amenity': 'cafe'},
+            {'amenity': 'bank'},
+            {'amenity': 'school'},
+            {'amenity': 'place_of_worship', 'religion': 'christian'},
+            {'shop': 'bakery'},
+            {'tourism': 'artwork', 'artwork_type': 'statue'},
+            {'highway': 'bus_stop', 'naptan:AtcoCode': '0000'},
+            {'leisure': 'park'},
+            {'craft': 'brewery'}]
+RURAL_TAGS = [{'natural': 'peak', 'ele': '400'},
+              {'place': 'hamlet'},
+              {'amenity': 'pub'},
+              {'leisure': 'park'}]
+EXTRA_TAGS = [('addr:street', 'High Street'),
+              ('addr:housenumber', '12'),
+              ('phone', '+44 1234 567890'),
+              ('opening_hours', 'Mo-Sa 09:00-17:00'),
+              ('wheelchair', 'yes'),
+              ('operator', 'Synthetic Ltd')]
+NAMES = ['Old Mill', 'Red Lion', 'Crown', 'Kings Arms', 'St Mary', 'Market', 'Station',
+         'Victoria', 'Albert', 'Oak', 'Elm', 'Rose and Crown', 'White Hart', 'George']
+
+TABLES = ['planet_osm_polygon', 'planet_osm_line', 'planet_osm_point']
+MARKER_TABLE = 'osmgaz_benchmark_dataset'
+CREATE_STATEMENTS = ['CREATE EXTENSION IF NOT EXISTS postgis',
+                     'CREATE EXTENSION IF NOT EXISTS hstore',
+                     'CREATE TABLE IF NOT EXISTS %s (seed INTEGER, complete BOOLEAN, created TIMESTAMP WITH TIME ZONE DEFAULT now())' % MARKER_TABLE,
+                     'DELETE FROM %s' % MARKER_TABLE,
+                     """INSERT INTO spatial_ref_sys (srid, auth_name, auth_srid, srtext, proj4text)
+                        SELECT 900913, 'spatialreferencing.org', 900913, srtext, proj4text FROM spatial_ref_sys
+                        WHERE srid = 3857 AND NOT EXISTS (SELECT 1 FROM spatial_ref_sys WHERE srid = 900913)""",
+                     'DROP TABLE IF EXISTS planet_osm_polygon',
+                     'DROP TABLE IF EXISTS planet_osm_line',
+                     'DROP TABLE IF EXISTS planet_osm_point',
+                     """CREATE TABLE planet_osm_polygon (osm_id BIGINT, name TEXT, z_order INTEGER, way_area REAL,
+                                                         way geometry(Geometry, 900913), tags hstore)""",
+                     """CREATE TABLE planet_osm_line (osm_id BIGINT, name TEXT, z_order INTEGER, way_area REAL,
+                                                      way geometry(Geometry, 900913), tags hstore)""",
+                     """CREATE TABLE planet_osm_point (osm_id BIGINT, name TEXT, z_order INTEGER,
+                                                       way geometry(Point, 900913), tags hstore)"""]
+
+
+def box(x1, y1, x2, y2):
+    """Return the WKT for a rectangle."""
+    return 'POLYGON((%f %f, %f %f, %f %f, %f %f, %f %f))' % (x1, y1, x2, y1, x2, y2, x1, y2, x1, y1)
+
+
+def synthetic_tags(rnd, tags):
+    """Add a random selection of the non-classifying tags to the tags."""
+    tags = dict(tags)
+    for key, value in rnd.sample(EXTRA_TAGS, rnd.randint(0, len(EXTRA_TAGS))):
+        tags[key] = value
+    return tags
+
+
+def generate(engine, seed=0, grid=30, pois=2000):
+    """Generate the synthetic data-set. Creates the OSM tables (dropping any existing
+    ones), fills them with synthetic features, and seeds the Flickr salience cache, as
+    the synthetic features have no Flickr data. The marker table identifies the
+    database as a benchmark data-set. Raises a ValueError if the database contains
+    OSM tables that were not generated.
+    """
+    if has_osm_tables(engine) and not has_marker(engine):
+        raise ValueError('%s contains OSM tables that were not generated by the benchmark' % engine.url)
+    rnd = random.Random(seed)
+    proj = Proj('+init=EPSG:3857')
+    ox, oy = proj(*ORIGIN)
+    for statement in CREATE_STATEMENTS:
+        engine.execute(text(statement))
+    engine.execute(text('INSERT INTO %s (seed, complete) VALUES (:seed, false)' % MARKER_TABLE), {'seed': seed})
+    polygons = []
+    lines = []
+    points = []
+    # Nested administrative areas: country, regions, counties, and parishes
+    half = COUNTRY_SIZE / 2
+    areas = [(ox - half, oy - half, ox + half, oy + half)]
+    for level, label in [('2', 'Country'), ('4', 'Region'), ('6', 'County'), ('8', 'Parish')]:
+        if level != '2':
+            areas = [sub for (x1, y1, x2, y2) in areas
+                     for sub in [(x1, y1, (x1 + x2) / 2, (y1 + y2) / 2),
+                                 ((x1 + x2) / 2, y1, x2, (y1 + y2) / 2),
+                                 (x1, (y1 + y2) / 2, (x1 + x2) / 2, y2),
+                                 ((x1 + x2) / 2, (y1 + y2) / 2, x2, y2)]]
+        for idx, (x1, y1, x2, y2) in enumerate(areas):
+            name = '%s %i' % (label, idx + 1)
+            polygons.append({'name': name,
+                             'way_area': (x2 - x1) * (y2 - y1),
+                             'way': box(x1, y1, x2, y2),
+                             'tags': {'boundary': 'administrative', 'admin_level': level}})
+            if level == '6' and idx % 2 == 0:
+                polygons.append({'name': name,
+                                 'way_area': (x2 - x1) * (y2 - y1),
+                                 'way': box(x1, y1, x2, y2),
+                                 'tags': {'boundary': 'ceremonial'}})
+    # Dense town: road grid split into segments, one building per block
+    town = grid * BLOCK_SIZE / 2
+    for idx in range(0, grid):
+        offset = idx * BLOCK_SIZE - town
+        for segment in range(0, grid - 1):
+            start = segment * BLOCK_SIZE - town
+            lines.append({'name': '%s Street' % NAMES[idx] if idx < len(NAMES) else 'Street %i' % idx,
+                          'way': 'LINESTRING(%f %f, %f %f)' % (ox + start, oy + offset, ox + start + BLOCK_SIZE, oy + offset),
+                          'tags': {'highway': 'residential'}})
+            lines.append({'name': '%s Road' % NAMES[idx] if idx < len(NAMES) else 'Road %i' % idx,
+                          'way': 'LINESTRING(%f %f, %f %f)' % (ox + offset, oy + start, ox + offset, oy + start + BLOCK_SIZE),
+                          'tags': {'highway': 'residential'}})
+    for bx in range(0, grid - 1):
+        for by in range(0, grid - 1):
+            x1 = ox + bx * BLOCK_SIZE - town + 30
+            y1 = oy + by * BLOCK_SIZE - town + 30
+            polygons.append({'name': '%s House' % rnd.choice(NAMES) if rnd.random() < 0.5 else '',
+                             'way_area': 40 * 40,
+                             'way': box(x1, y1, x1 + 40, y1 + 40),
+                             'tags': synthetic_tags(rnd, {'building': 'yes'})})
+    for idx in range(0, pois):
+        points.append({'name': '%s %i' % (rnd.choice(NAMES), idx % 50),
+                       'way': 'POINT(%f %f)' % (ox + rnd.uniform(-town, town), oy + rnd.uniform(-town, town)),
+                       'tags': synthetic_tags(rnd, rnd.choice(POI_TAGS))})
+    # Sparse rural features across the whole country
+    for idx in range(0, pois // 4):
+        points.append({'name': 'Rural %s %i' % (rnd.choice(NAMES), idx),
+                       'way': 'POINT(%f %f)' % (ox + rnd.uniform(-half, half), oy + rnd.uniform(-half, half)),
+                       'tags': synthetic_tags(rnd, rnd.choice(RURAL_TAGS))})
+    osm_id = 0
+    for rows in [polygons, lines, points]:
+        for row in rows:
+            osm_id = osm_id + 1
+            row['osm_id'] = osm_id
+            row['z_order'] = 0
+            row['way'] = WKTElement(row['way'], srid=900913)
+    with redirect_stdout(sys.stderr):
+        setup_db(GenerateArgs(str(engine.url)))
+    engine.execute(Polygon.__table__.insert(), polygons)
+    engine.execute(Line.__table__.insert(), lines)
+    engine.execute(Point.__table__.insert(), points)
+    for table in TABLES:
+        engine.execute(text('CREATE INDEX %s_way_idx ON %s USING GIST (way)' % (table, table)))
+        engine.execute(text('CREATE INDEX %s_name_idx ON %s (name)' % (table, table)))
+        engine.execute(text('INSERT INTO flickr_salience_cache (toponym_id, salience) SELECT gid, 0 FROM %s' % table))
+        engine.execute(text('ANALYZE %s' % table))
+    engine.execute(text('UPDATE %s SET complete = true' % MARKER_TABLE))
+    logging.info('Generated %i polygons, %i lines, and %i points' % (len(polygons), len(lines), len(points)))
+    return {'polygons': len(polygons), 'lines': len(lines), 'points': len(points)}
+
+
+def has_table(engine, table):
+    return engine.execute(text("SELECT to_regclass('%s') IS NOT NULL" % table)).scalar()
+
+
+def has_osm_tables(engine):
+    """Check whether the database contains any of the OSM tables."""
+    return any([has_table(engine, table) for table in TABLES])
+
+
+def has_marker(engine):
+    """Check whether the database contains the marker table, even if the generation did
+    not complete."""
+    return has_table(engine, MARKER_TABLE)
+
+
+def is_benchmark_dataset(engine):
+    """Check whether the database contains a complete data-set written by
+    :func:`generate`."""
+    return has_marker(engine) and \
+        engine.execute(text('SELECT count(*) FROM %s WHERE complete' % MARKER_TABLE)).scalar() > 0
+
+
+def lookup_points(count, seed=0, grid=30):
+    """Generate the lookup points, half of them in the town, half of them rural."""
+    rnd = random.Random(seed + 1)
+    proj = Proj('+init=EPSG:3857')
+    ox, oy = proj(*ORIGIN)
+    town = grid * BLOCK_SIZE / 2
+    rural = COUNTRY_SIZE / 2 - 1000
+    points = []
+    for idx in range(0, count):
+        if idx % 2 == 0:
+            x, y = ox + rnd.uniform(-town, town), oy + rnd.uniform(-town, town)
+        else:
+            x, y = ox + rnd.uniform(town, rural) * rnd.choice([-1, 1]), oy + rnd.uniform(-rural, rural)
+        points.append(proj(x, y, inverse=True))
+    return points
+
+
+def summarise(timings):
+    """Summarise a list of timings (seconds) into throughput and latency percentiles."""
+    if not timings:
+        return {'count': 0}
+    return {'count': len(timings),
+            'throughput': len(timings) / sum(timings),
+            'p50': float(percentile(timings, 50)),
+            'p95': float(percentile(timings, 95)),
+            'p99': float(percentile(timings, 99))}
+
+
+def bench_classifier(seed=0, count=10000):
+    """Measure the classifier throughput on synthetic tags."""
+    rnd = random.Random(seed)
+    classifier = ToponymClassifier()
+    toponyms = [SyntheticToponym('Synthetic', synthetic_tags(rnd, rnd.choice(POI_TAGS + RURAL_TAGS)))
+                for _ in range(0, count)]
+    start = time.perf_counter()
+    for toponym in toponyms:
+        classifier(toponym)
+    elapsed = time.perf_counter() - start
+    evaluated = 0
+    for toponym in toponyms:
+        for idx, rule in enumerate(classifier.rules):
+            if all([key in toponym.tags and (value is None or toponym.tags[key] == value)
+                    for key, value in rule['rules'].items()]):
+                break
+        evaluated = evaluated + idx + 1
+    return {'features': count,
+            'rules': len(classifier.rules),
+            'features_per_second': count / elapsed,
+            'rules_per_second': evaluated / elapsed}
+
+
+def reset_caches(session):
+    """Remove all cached lookups and name and type salience values."""
+    for obj in [LookupCache, SpatialLookupCache, NameSalienceCache, TypeSalienceCache]:
+        session.query(obj).delete(synchronize_session=False)
+    session.commit()
+
+
+def bench_lookups(sqla_url, points, cache='point', prepared=False, cache_tolerance=25):
+    """Measure the cold and warm lookup latency. The cold run starts with empty lookup
+    and salience caches, the warm run repeats the same points."""
+    from osmgaz import OSMGaz
+    gaz = OSMGaz(sqla_url, cache=cache, prepared=prepared, cache_tolerance=cache_tolerance)
+    reset_caches(gaz.session)
+    result = {}
+    for run in ['cold', 'warm']:
+        timings = []
+        for point in points:
+            start = time.perf_counter()
+            gaz(point)
+            timings.append(time.perf_counter() - start)
+        result[run] = summarise(timings)
+    return result
+
+
+def bench_statements(sqla_url, points):
+    """Measure the containment and proximal gazetteer latency with ORM-built queries and
+    with prepared statements. The points are queried in a cold and a warm pass, which
+    are reported separately. The statements are prepared during the cold pass, thus
+    its first query also includes the planning that the warm pass avoids. The latency
+    of that first query is reported as first."""
+    from osmgaz import OSMGaz
+    result = {}
+    for prepared in [False, True]:
+        gaz = OSMGaz(sqla_url, prepared=prepared)
+        passes = {}
+        for run in ['cold', 'warm']:
+            timings = {'containment': [], 'proximal': []}
+            for point in points:
+                start = time.perf_counter()
+                containment = gaz.containment_gaz(point)
+                timings['containment'].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                gaz.proximal_gaz(point, containment)
+                timings['proximal'].append(time.perf_counter() - start)
+            passes[run] = dict([(key, summarise(value)) for key, value in timings.items()])
+            passes[run]['first'] = dict([(key, value[0] if value else None) for key, value in timings.items()])
+        result['prepared' if prepared else 'orm'] = passes
+        gaz.session.close()
+    return result
+
+
+def throughput(rows, elapsed):
+    return {'rows': rows, 'seconds': elapsed, 'rows_per_second': rows / elapsed if elapsed > 0 else None}
+
+
+def bench_preprocess(session):
+    """Measure the throughput of the pre-processing stages: classification, urban
+    cells, containment, and salience. The throughput is relative to the named features."""
+    classifier = ToponymClassifier()
+    containment_filter = ContainmentFilter(ContainmentGazetteer(session))
+    rows = dict([(obj, session.query(obj).filter(obj.name != '').count()) for obj in [Polygon, Line, Point]])
+    result = {'classify': {}, 'containment': {}}
+    for obj in [Polygon, Line, Point]:
+        start = time.perf_counter()
+        preprocess.classify(session, obj, classifier, True)
+        result['classify'][obj.__name__] = throughput(rows[obj], time.perf_counter() - start)
+    start = time.perf_counter()
+    preprocess.build_urban_grid(session)
+    result['urban_cells'] = throughput(sum(rows.values()), time.perf_counter() - start)
+    for obj in [Polygon, Line, Point]:
+        start = time.perf_counter()
+        preprocess.containment_join(session, obj)
+        preprocess.select_containers(session, containment_filter, obj)
+        result['containment'][obj.__name__] = throughput(rows[obj], time.perf_counter() - start)
+    start = time.perf_counter()
+    preprocess.salience(session, True)
+    result['salience'] = throughput(sum(rows.values()), time.perf_counter() - start)
+    return result
+
+
+def run(args):
+    """Runs the benchmark suite and writes the results as JSON."""
+    logging.root.setLevel(logging.INFO)
+    engine = create_engine(args.sqla_url)
+    session = sessionmaker(bind=engine)()
+    results = {}
+    if args.generate:
+        try:
+            results['dataset'] = generate(engine, seed=args.seed)
+        except ValueError as e:
+            sys.exit(str(e))
+    elif not is_benchmark_dataset(engine):
+        sys.exit('%s is not a benchmark data-set. Use --generate on an empty database.' % engine.url)
+    points = lookup_points(args.points, seed=args.seed)
+    results['classifier'] = bench_classifier(seed=args.seed)
+    results['lookup'] = bench_lookups(args.sqla_url, points, cache=args.cache, prepared=args.prepared,
+                                      cache_tolerance=args.cache_tolerance)
+    results['statements'] = bench_statements(args.sqla_url, points)
+    results['preprocess'] = bench_preprocess(session)
+    if args.output:
+        with open(args.output, 'w') as out_f:
+            json.dump(results, out_f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
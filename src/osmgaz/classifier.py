@@ -5,47 +5,237 @@ which are returned as a list. An empty list means nothing matched
 
 .. moduleauthor:: Mark Hall <mark.hall@mail.room3b.eu>
 """
+import heapq
 import json
 import logging
+import math
+import tempfile
+import time
 
+from collections import Counter
 from copy import deepcopy
 from geoalchemy2 import shape
 from httplib2 import Http
+from itertools import groupby
 from pkg_resources import resource_stream
 from pyproj import Proj
 from rdflib import Graph, URIRef
 from rdflib.namespace import RDFS
 from shapely import geometry
-from sqlalchemy import and_, not_
+from sqlalchemy import and_, not_, text
 from urllib.parse import urlencode
 
 from .filters import type_match
-from .models import (Point, Line, Polygon, NameSalienceCache, TypeSalienceCache, FlickrSalienceCache)
+from .models import (Point, Line, Polygon, NameSalienceCache, TypeSalienceCache, FlickrSalienceCache,
+                     PreprocessStatus, UrbanCell, way_clause)
+
+URBAN_CELL_SIZE = 100
+URBAN_DISTANCE = 400
+URBAN_GRID_STAGE = 'urban_grid'
 
 
 class UrbanRuralClassifier(object):
     """Urban/Rural classification based on whether there is a building within
     400m. 
+
+    If a session is given and the urban cell grid has been completely pre-processed,
+    then the classification is a single cell lookup and does not need the proximal
+    toponyms.
+    The grid marks all cells of URBAN_CELL_SIZE whose centre is within URBAN_DISTANCE
+    of a building.
     """
     
-    def __init__(self):
+    def __init__(self, session=None):
         self.proj = Proj('+init=EPSG:3857')
+        self.session = session
+        self.grid = None
+    
+    def has_grid(self):
+        """Check (once) whether the building of the urban cell grid has completed.
+        Databases set up before the grid was added have no status table."""
+        if self.grid is None:
+            self.grid = False
+            if self.session is not None:
+                if self.session.execute(text("SELECT to_regclass('%s') IS NOT NULL" % PreprocessStatus.__tablename__)).scalar():
+                    self.grid = self.session.query(PreprocessStatus).filter(PreprocessStatus.stage == URBAN_GRID_STAGE).first() is not None
+        return self.grid
     
-    def __call__(self, point, toponyms):
+    def __call__(self, point, toponyms=None):
+        """Classify the point. Uses the urban cell grid if available, otherwise the
+        toponyms. Returns None if neither is available."""
+        if self.has_grid():
+            x, y = self.proj(*point)
+            cell = self.session.query(UrbanCell).filter(and_(UrbanCell.x == int(math.floor(x / URBAN_CELL_SIZE)),
+                                                             UrbanCell.y == int(math.floor(y / URBAN_CELL_SIZE)))).first()
+            if cell is not None:
+                return 'URBAN'
+            return 'RURAL'
+        if toponyms is None:
+            return None
         point = geometry.Point(*self.proj(*point))
         for toponym, type_ in toponyms:
-            if point.distance(shape.to_shape(toponym.way)) <= 400 and type_match(type_['type'], ['ARTIFICIAL FEATURE', 'BUILDING']):
+            if not type_match(type_['type'], ['ARTIFICIAL FEATURE', 'BUILDING']):
+                continue
+            distance = getattr(toponym, 'distance', None)
+            if distance is None:
+                distance = point.distance(shape.to_shape(toponym.way))
+            if distance <= URBAN_DISTANCE:
                 return 'URBAN'
         return 'RURAL'
 
 
+IGNORED_TAGS = frozenset(['name', 'phone', 'wikipedia', 'route_name', 'route_pref_color', 'way_area', 'building:part',
+                          'website', 'wheelchair', 'postal_code', 'license_notice', 'description', 'operator', 'alt_name',
+                          'email', 'old_name', 'date', 'opening_hours', 'genus', 'inscription', 'url', 'height', 'ref',
+                          'direction', 'is_in', 'species', 'wpt_description', 'wpt_symbol', 'ele', 'capacity', 'occupier',
+                          'polling_station', 'layer'])
+IGNORED_TAG_PREFIXES = ('addr:', 'name:', 'building:', 'roof:', 'disused:', 'ref:', 'is_in:', 'contact:', 'date:',
+                        'genus:', 'seamark:')
+
+
+def unknown_signature(tags, match_tags=None):
+    """Normalise the tags into a hashable signature, without the non-relevant tags and
+    the tags that were matched by the rule."""
+    tags = tuple(sorted([(key, value) for key, value in tags.items()
+                         if key not in IGNORED_TAGS and not key.startswith(IGNORED_TAG_PREFIXES)
+                         and not (match_tags and key in match_tags)]))
+    if match_tags:
+        return (tags, tuple(sorted(match_tags.items())))
+    return (tags, None)
+
+
+class UnknownTags(object):
+    """Aggregates the unknown tag signatures with their counts. At most max_size distinct
+    signatures are held in memory (no limit if max_size is None). If a stream is set,
+    then the counts are written to it whenever that limit is reached, or every
+    flush_interval seconds, otherwise further new signatures are only counted as dropped.
+    A signature may thus be written several times with partial counts. Counters from
+    several processes or flushes can be combined with :meth:`merge` and :meth:`read`.
+    """
+    
+    def __init__(self, max_size=10000, stream=None, flush_interval=300):
+        self.max_size = max_size
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self.counts = Counter()
+        self.dropped = 0
+        self.last_flush = time.time()
+    
+    def add(self, signature, count=1):
+        """Count the signature. Returns True if the signature was not yet held."""
+        if self.stream is not None and self.flush_interval is not None and \
+                time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+        if signature in self.counts:
+            self.counts[signature] += count
+            return False
+        if self.max_size is not None and len(self.counts) >= self.max_size:
+            if self.stream is None:
+                self.dropped = self.dropped + count
+                return False
+            self.flush()
+        self.counts[signature] = count
+        return True
+    
+    def read(self, stream):
+        """Add all counts from a stream written by :meth:`flush`."""
+        for line in stream:
+            line = line.strip()
+            if line:
+                item = json.loads(line)
+                match_tags = None
+                if 'match_tags' in item:
+                    match_tags = tuple(sorted(item['match_tags'].items()))
+                self.add((tuple(sorted(item['tags'].items())), match_tags), item['count'])
+    
+    def merge(self, other):
+        """Add all counts from the other UnknownTags."""
+        for signature, count in other.counts.items():
+            self.add(signature, count)
+        self.dropped = self.dropped + other.dropped
+    
+    def items(self):
+        """Return the unknown tags as a list of dictionaries, most frequent first."""
+        result = []
+        for (tags, match_tags), count in self.counts.most_common():
+            item = {'tags': dict(tags), 'count': count}
+            if match_tags:
+                item['match_tags'] = dict(match_tags)
+            result.append(item)
+        return result
+    
+    def clear(self):
+        self.counts.clear()
+        self.dropped = 0
+    
+    def flush(self):
+        """Write the held counts to the stream, one JSON object per line, and clear them."""
+        if self.stream is not None:
+            for item in self.items():
+                self.stream.write('%s\n' % json.dumps(item))
+            self.stream.flush()
+            if self.dropped:
+                logging.warning('Dropped %i unknown tags' % self.dropped)
+        self.clear()
+        self.last_flush = time.time()
+
+
+def write_chunk(counts):
+    """Write the counts, sorted by their signature key, to a temporary file."""
+    chunk = tempfile.TemporaryFile(mode='w+')
+    for key in sorted(counts):
+        chunk.write('%s\n' % json.dumps([key, counts[key]]))
+    chunk.seek(0)
+    return chunk
+
+
+def merge_unknown(filenames, output, chunk_size=100000):
+    """Re-aggregate the unknown tags files (for example the partial flushes of a single
+    run, or the files of several workers) into the output file, one line per signature,
+    ordered by signature. The output may be one of the input files. Returns the number
+    of signatures.
+
+    At most chunk_size signatures are held in memory. Each chunk is written, sorted, to
+    a temporary file and the sorted chunks are then merged.
+    """
+    chunks = []
+    try:
+        counts = Counter()
+        for filename in filenames:
+            with open(filename) as in_f:
+                for line in in_f:
+                    line = line.strip()
+                    if line:
+                        item = json.loads(line)
+                        count = item.pop('count')
+                        counts[json.dumps(item, sort_keys=True)] += count
+                        if len(counts) >= chunk_size:
+                            chunks.append(write_chunk(counts))
+                            counts.clear()
+        if counts:
+            chunks.append(write_chunk(counts))
+            counts.clear()
+        signatures = 0
+        with open(output, 'w') as out_f:
+            merged = heapq.merge(*[(json.loads(line) for line in chunk) for chunk in chunks])
+            for key, group in groupby(merged, key=lambda entry: entry[0]):
+                item = json.loads(key)
+                item['count'] = sum([count for _, count in group])
+                out_f.write('%s\n' % json.dumps(item))
+                signatures = signatures + 1
+        return signatures
+    finally:
+        for chunk in chunks:
+            chunk.close()
+
+
 class ToponymClassifier(object):
     """Classifies toponyms based on the rules defined in the ontology.
     """
     
-    def __init__(self):
+    def __init__(self, max_unknown=10000):
         self.load_rules()
-        self.unknown = []
+        self.unknown = UnknownTags(max_unknown)
     
     def load_rules(self):
         """Load the classification rules from the ontology.
@@ -116,38 +306,23 @@ class ToponymClassifier(object):
             self.rules.insert(0, {'rules': rule})
     
     def get_unknown(self):
-        """Return the list of all unknown toponym types.
+        """Return the list of all unknown toponym types, with their counts.
         """
-        result = self.unknown
-        self.unknown = []
+        result = self.unknown.items()
+        self.unknown.clear()
         return result
     
     def log_unknown(self, tags, match_tags=None):
         """Helper function that filters out some non-relevant tags and then only logs those
         tags as unknown that are distinct from that set.
         """
-        for kw in ['name', 'phone', 'wikipedia', 'route_name', 'route_pref_color', 'way_area', 'building:part',
-                   'website', 'wheelchair', 'postal_code', 'license_notice', 'description', 'operator', 'alt_name',
-                   'email', 'old_name', 'date', 'opening_hours', 'genus', 'inscription', 'url', 'height', 'ref',
-                   'direction', 'is_in', 'species', 'wpt_description', 'wpt_symbol', 'ele', 'capacity', 'occupier',
-                   'polling_station', 'layer']:
-            if kw in tags:
-                del tags[kw]
-        for tag in list(tags):
-            for kw in ['addr:', 'name:', 'building:', 'roof:', 'disused:', 'ref:', 'is_in:', 'contact:', 'date:',
-                       'genus:', 'seamark:']:
-                if tag.startswith(kw):
-                    del tags[tag]
-            if match_tags and tag in match_tags:
-                del tags[tag]
-        if len(tags) > 0:
-            if tags not in self.unknown:
+        signature = unknown_signature(tags, match_tags)
+        if signature[0]:
+            if self.unknown.add(signature):
                 if match_tags:
-                    self.unknown.append((tags, match_tags))
-                    logging.debug(json.dumps(tags) + ' - ' + json.dumps(match_tags))
+                    logging.debug(json.dumps(dict(signature[0])) + ' - ' + json.dumps(match_tags))
                 else:
-                    self.unknown.append(tags)
-                    logging.debug(json.dumps(tags))
+                    logging.debug(json.dumps(dict(signature[0])))
     
     def __call__(self, toponym):
         """Apply the classification rules to the given toponym.
@@ -161,11 +336,11 @@ class ToponymClassifier(object):
             if matches:
                 if 'type' in rule:
                     if('warn' in rule and rule['warn']):
-                        self.log_unknown(deepcopy(toponym.tags), deepcopy(rule['rules']))
+                        self.log_unknown(toponym.tags, rule['rules'])
                     return {'type': deepcopy(rule['type'])}
                 else:
                     return None
-        self.log_unknown(deepcopy(toponym.tags))
+        self.log_unknown(toponym.tags)
         return None
 
 
@@ -173,37 +348,66 @@ class NameSalienceCalculator(object):
     """Calculates the uniqueness of the given name within the container.
     """
     
-    def __init__(self, session):
+    def __init__(self, session, instrumentation=None, statements=None):
         self.session = session
+        self.instrumentation = instrumentation
+        self.statements = statements
+
+    def prepared(self, toponym, classification, containers):
+        """Calculates the name salience using the prepared statements."""
+        cache = self.statements.scalar(self.session, 'name_salience_cache', (toponym.category,
+                                                                             toponym.gid,
+                                                                             containers[0][0].gid))
+        if self.instrumentation is not None:
+            self.instrumentation.cache('name_salience_cache', cache is not None)
+        if cache is not None:
+            return cache, True
+        if type_match(classification['type'], ['ARTIFICIAL FEATURE', 'TRANSPORT', 'PUBLIC']):
+            count = self.statements.scalar(self.session, 'name_count', (toponym.name, containers[0][0].gid))
+        else:
+            count = self.statements.scalar(self.session, 'name_count_other', (toponym.name, containers[0][0].gid))
+        return count if count is not None else 0, False
 
     def __call__(self, toponym, classification, containers):
         logging.debug('Calculating name salience for %s in %s' % (toponym.name, containers[0][0].name))
-        cache = self.session.query(NameSalienceCache).filter(and_(NameSalienceCache.category == type(toponym).__name__,
+        if self.statements is not None:
+            count, cached = self.prepared(toponym, classification, containers)
+            if cached:
+                return count
+            return self.store(toponym, containers, count)
+        cache = self.session.query(NameSalienceCache).filter(and_(NameSalienceCache.category == toponym.category,
                                                                   NameSalienceCache.toponym_id == toponym.gid,
                                                                   NameSalienceCache.container_id == containers[0][0].gid)).first()
+        if self.instrumentation is not None:
+            self.instrumentation.cache('name_salience_cache', cache is not None)
         if cache:
             return cache.salience
+        container_way = way_clause(containers[0][0])
         if type_match(classification['type'], ['ARTIFICIAL FEATURE', 'TRANSPORT', 'PUBLIC']):
             count = self.session.query(Point).filter(and_(Point.name == toponym.name,
-                                                          Point.way.ST_DWithin(containers[0][0].way, 400))).count()
+                                                          Point.way.ST_DWithin(container_way, 400))).count()
             count = count + self.session.query(Line).filter(and_(Line.name == toponym.name,
-                                                                 Line.way.ST_DWithin(containers[0][0].way, 400))).count()
+                                                                 Line.way.ST_DWithin(container_way, 400))).count()
             count = count + self.session.query(Polygon).filter(and_(Polygon.name == toponym.name,
-                                                                    Polygon.way.ST_DWithin(containers[0][0].way, 400))).count()
+                                                                    Polygon.way.ST_DWithin(container_way, 400))).count()
         else:
             count = self.session.query(Point).filter(and_(Point.name == toponym.name,
                                                           not_(Point.classification.startswith('ARTIFICIAL FEATURE::TRANSPORT::PUBLIC')),
-                                                          Point.way.ST_DWithin(containers[0][0].way, 400))).count()
+                                                          Point.way.ST_DWithin(container_way, 400))).count()
             count = count + self.session.query(Line).filter(and_(Line.name == toponym.name,
                                                                  not_(Line.classification.startswith('ARTIFICIAL FEATURE::TRANSPORT::PUBLIC')),
-                                                                 Line.way.ST_DWithin(containers[0][0].way, 400))).count()
+                                                                 Line.way.ST_DWithin(container_way, 400))).count()
             count = count + self.session.query(Polygon).filter(and_(Polygon.name == toponym.name,
                                                                     not_(Polygon.classification.startswith('ARTIFICIAL FEATURE::TRANSPORT::PUBLIC')),
-                                                                    Polygon.way.ST_DWithin(containers[0][0].way, 400))).count()
+                                                                    Polygon.way.ST_DWithin(container_way, 400))).count()
+        return self.store(toponym, containers, count)
+
+    def store(self, toponym, containers, count):
+        """Calculates the salience from the count and adds it to the cache."""
         salience = 0
         if count > 0:
             salience = 1.0 / count
-        self.session.add(NameSalienceCache(category=type(toponym).__name__,
+        self.session.add(NameSalienceCache(category=toponym.category,
                                            toponym_id=toponym.gid,
                                            container_id=containers[0][0].gid,
                                            salience=salience))
@@ -215,23 +419,40 @@ class TypeSalienceCalculator(object):
     """Calculates the uniqueness of the given toponym type within the container.
     """
     
-    def __init__(self, session):
+    def __init__(self, session, instrumentation=None, statements=None):
         self.session = session
+        self.instrumentation = instrumentation
+        self.statements = statements
         self.classifier = ToponymClassifier()
 
     def __call__(self, type_, containers):
         type_ = '::'.join(type_['type'])
         logging.debug('Calculating type salience for %s in %s' % (type_, containers[0][0].name))
+        if self.statements is not None:
+            cache = self.statements.scalar(self.session, 'type_salience_cache', (type_, containers[0][0].gid))
+            if self.instrumentation is not None:
+                self.instrumentation.cache('type_salience_cache', cache is not None)
+            if cache is not None:
+                return cache
+            count = self.statements.scalar(self.session, 'type_count', (type_, containers[0][0].gid))
+            return self.store(type_, containers, count if count is not None else 0)
         cache = self.session.query(TypeSalienceCache).filter(and_(TypeSalienceCache.toponym_type == type_,
                                                                   TypeSalienceCache.container_id == containers[0][0].gid)).first()
+        if self.instrumentation is not None:
+            self.instrumentation.cache('type_salience_cache', cache is not None)
         if cache:
             return cache.salience
+        container_way = way_clause(containers[0][0])
         count = self.session.query(Point).filter(and_(Point.classification.startswith(type_),
-                                                      Point.way.ST_DWithin(containers[0][0].way, 400))).count()
+                                                      Point.way.ST_DWithin(container_way, 400))).count()
         count = count + self.session.query(Line).filter(and_(Line.classification.startswith(type_),
-                                                             Line.way.ST_DWithin(containers[0][0].way, 400))).count()
+                                                             Line.way.ST_DWithin(container_way, 400))).count()
         count = count + self.session.query(Polygon).filter(and_(Polygon.classification.startswith(type_),
-                                                                Polygon.way.ST_DWithin(containers[0][0].way, 400))).count()
+                                                                Polygon.way.ST_DWithin(container_way, 400))).count()
+        return self.store(type_, containers, count)
+
+    def store(self, type_, containers, count):
+        """Calculates the salience from the count and adds it to the cache."""
         salience = 0
         if count > 0:
             salience = 1.0 / count
@@ -246,8 +467,9 @@ class FlickrSalienceCalculator(object):
     """Calculates the salience of a set of toponyms based on Flickr photograph use.
     """
     
-    def __init__(self, session):
+    def __init__(self, session, instrumentation=None):
         self.session = session
+        self.instrumentation = instrumentation
         self.classifier = ToponymClassifier()
         self.proj = Proj('+init=EPSG:3857')
 
@@ -256,6 +478,8 @@ class FlickrSalienceCalculator(object):
         if type_match(classification['type'], ['ARTIFICIAL FEATURE', 'TRANSPORT', 'PUBLIC']):
             return 0
         cache = self.session.query(FlickrSalienceCache).filter(FlickrSalienceCache.toponym_id == toponym.gid).first()
+        if self.instrumentation is not None:
+            self.instrumentation.cache('flickr_salience_cache', cache is not None)
         if cache is not None:
             return int(cache.salience)
         else:
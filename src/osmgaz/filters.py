@@ -7,7 +7,7 @@ The filters module implements the functionality for filtering lists of toponyms.
 from shapely.geometry import Point
 from sqlalchemy import and_
 
-from .models import Polygon
+from .models import Polygon, way_clause
 
 def type_match(haystack, needle):
     """Check whether the needle list is fully contained within the haystack
@@ -52,7 +52,7 @@ class ContainmentFilter(object):
             if len(filtered) == 0 or prev_size / toponym.way_area <= 0.25 or type_match(classification['type'], ['ARTIFICIAL FEATURE', 'BUILDING']):
                 filtered.append((toponym, classification))
                 prev_size = toponym.way_area
-        if len(hierarchy) > 0 and len(filtered) > 0 and hierarchy[-1][0].tags['admin_level'] != filtered[-1][0].tags['admin_level']:
+        if len(hierarchy) > 0 and len(filtered) > 0 and hierarchy[-1][0].admin_level != filtered[-1][0].admin_level:
             filtered.append(hierarchy[-1])
         return filtered
 
@@ -61,10 +61,14 @@ class ContainmentFilter(object):
         at figure_idx is unique within the ground_idx toponym. Removes pointless complexity
         from the list of containment toponyms. Buildings are never filtered.
         """
-        query = self.containment_gaz.session.query(Polygon).filter(and_(Polygon.name == toponyms[figure_idx][0].name,
-                                                                        Polygon.way.ST_Intersects(toponyms[ground_idx][0].way)))
         unique = True
-        for toponym, classification in self.containment_gaz.query(query):
+        intersecting = self.containment_gaz.prepared(Polygon, 'unique', (toponyms[figure_idx][0].name,
+                                                                         toponyms[ground_idx][0].gid))
+        if intersecting is None:
+            intersecting = self.containment_gaz.query(Polygon,
+                                                      and_(Polygon.name == toponyms[figure_idx][0].name,
+                                                           Polygon.way.ST_Intersects(way_clause(toponyms[ground_idx][0]))))
+        for toponym, classification in intersecting:
             if toponym.osm_id != toponyms[figure_idx][0].osm_id:
                 if classification and classification['type'][:2] == toponyms[figure_idx][1]['type'][:2]:
                     unique = False
@@ -5,40 +5,90 @@
 """
 import logging
 
-from sqlalchemy import and_
-from geoalchemy2 import WKTElement
+from sqlalchemy import and_, not_, func
 from pyproj import Proj
 
 from .classifier import ToponymClassifier
 from .filters import type_match
-from .models import Polygon, Line, Point
+from .models import Polygon, Line, Point, Toponym
+
+def make_point(coords):
+    """Return an SQL expression for the projected point, with bound numeric coordinates."""
+    return func.ST_SetSRID(func.ST_MakePoint(coords[0], coords[1]), 900913)
+
 
 class Gazetteer(object):
     """Generic Gazetteer object that creates the database connection.
+
+    If statements are given, then the hot queries are run as server-side prepared
+    statements (see :mod:`osmgaz.statements`).
     """
     
-    def __init__(self, session):
+    def __init__(self, session, statements=None):
         self.session = session
+        self.statements = statements
         self.proj = Proj('+init=EPSG:3857')
         self.classifier = ToponymClassifier()
     
-    def query(self, query):
-        """Runs the given query against the database and returns those
-        toponyms that can be classifed using the classifier module.
+    def columns(self, obj, point=None):
+        """The columns loaded for a toponym of type obj. If a point is given, then the
+        distance to the point is calculated in the database."""
+        columns = [obj.gid, obj.osm_id, obj.name, obj.classification]
+        if obj is Polygon:
+            columns.extend([obj.way_area, obj.tags['admin_level']])
+        if point is not None:
+            columns.append(obj.way.ST_Distance(point))
+        return columns
+    
+    def query(self, obj, criteria, point=None):
+        """Runs a query for the toponyms of type obj that match the criteria and returns
+        those toponyms that can be classifed using the classifier module. Only the columns
+        needed for filtering are loaded, as :class:`~osmgaz.models.Toponym`. If a point is
+        given, then the distance to the point is calculated in the database.
         """
+        query = self.session.query(*self.columns(obj, point)).filter(criteria)
+        return self.toponyms(obj, query, point is not None)
+    
+    def prepared(self, obj, name, params):
+        """Runs the named prepared statement and returns the classified toponyms. Returns
+        None if no prepared statements are configured."""
+        if self.statements is None:
+            return None
+        return self.toponyms(obj,
+                             self.statements.execute(self.session, name, params),
+                             name.startswith('proximal_') or name.startswith('nearest_'))
+    
+    def toponyms(self, obj, rows, distance=False):
+        """Converts the rows (gid, osm_id, name, classification, then way_area and
+        admin_level for polygons, then optionally the distance) into toponyms and
+        classifies those toponyms that have not yet been classified."""
         toponyms = []
-        classified = 0
-        for toponym in query:
+        unclassified = {}
+        for row in rows:
+            toponym = Toponym(obj.category, row[0], row[1], row[2], classification=row[3], session=self.session)
+            if obj is Polygon:
+                toponym.way_area = row[4]
+                toponym.admin_level = row[5]
+            if distance:
+                toponym.distance = row[-1]
             if toponym.classification is None:
+                unclassified[toponym.gid] = toponym
+            else:
+                toponyms.append((toponym, {'type': toponym.classification.split('::')}))
+        if unclassified:
+            classified = 0
+            for gid, tags in self.session.query(obj.gid, obj.tags).filter(obj.gid.in_(list(unclassified))):
+                toponym = unclassified[gid]
+                toponym.tags = tags if tags is not None else {}
                 classification = self.classifier(toponym)
                 if classification:
                     classified = classified + 1
                     toponym.classification = '::'.join(classification['type'])
+                    self.session.query(obj).filter(obj.gid == gid).update({obj.classification: toponym.classification},
+                                                                           synchronize_session=False)
                     toponyms.append((toponym, classification))
-            else:
-                toponyms.append((toponym, {'type': toponym.classification.split('::')}))
-        if classified > 0:
-            self.session.commit()
+            if classified > 0:
+                self.session.commit()
         return toponyms
         
 
@@ -51,39 +101,111 @@ class ContainmentGazetteer(Gazetteer):
         """
         logging.info('Retrieving containment toponyms for %.5f,%.5f' % point)
         coords = self.proj(*point)
-        toponyms = self.query(self.session.query(Polygon).filter(and_(Polygon.name != '',
-                                                                      Polygon.way.ST_Contains(WKTElement('POINT(%f %f)' % coords,
-                                                                                                         srid=900913)))))
+        toponyms = self.prepared(Polygon, 'containment', coords)
+        if toponyms is None:
+            toponyms = self.query(Polygon, and_(Polygon.name != '',
+                                                Polygon.way.ST_Contains(make_point(coords))))
         toponyms.sort(key=lambda i: i[0].way_area)
         return toponyms
 
 
 class ProximalGazetteer(Gazetteer):
     """Handles proximal queries.
+
+    If top_k is set, then instead of the expanding radius search only the top_k nearest
+    toponyms per feature table within max_distance are retrieved, bounding the number of
+    toponyms per lookup regardless of the feature density. Polygons that contain the
+    point are never counted towards the top_k, as they are containment toponyms.
     """
     
-    def __call__(self, point, containment):
+    def __init__(self, session, top_k=None, max_distance=3000, statements=None):
+        Gazetteer.__init__(self, session, statements)
+        self.top_k = top_k
+        self.max_distance = max_distance
+    
+    def nearest_rows(self, obj, coords, exclude, offset):
+        """Retrieves one page of top_k rows of type obj, ordered by the distance to the
+        point, starting at offset. Polygons that contain the point or whose gid is in
+        exclude are skipped."""
+        if self.statements is not None:
+            params = (coords[0], coords[1], self.max_distance, self.top_k, offset)
+            if obj is Polygon:
+                params = params + (list(exclude),)
+            return self.statements.execute(self.session, 'nearest_%s' % obj.category.lower(), params)
+        point = make_point(coords)
+        criteria = [obj.name != '', obj.way.ST_DWithin(point, self.max_distance)]
+        if obj is Polygon:
+            criteria.append(not_(obj.way.ST_Contains(point)))
+            if exclude:
+                criteria.append(not_(obj.gid.in_(list(exclude))))
+        return self.session.query(*self.columns(obj, point)).filter(and_(*criteria)).\
+            order_by(obj.way.distance_centroid(point)).offset(offset).limit(self.top_k).all()
+    
+    def nearest_classified(self, obj, coords, exclude):
+        """Retrieves the top_k nearest classified toponyms of type obj. Rows that cannot
+        be classified are only discarded after they have been loaded, thus further pages
+        are loaded until top_k toponyms have been classified or no rows are left."""
+        toponyms = []
+        offset = 0
+        while len(toponyms) < self.top_k:
+            rows = self.nearest_rows(obj, coords, exclude, offset)
+            toponyms.extend(self.toponyms(obj, rows, True))
+            if len(rows) < self.top_k:
+                break
+            offset = offset + len(rows)
+        toponyms.sort(key=lambda t: t[0].distance)
+        return toponyms[:self.top_k]
+    
+    def nearest(self, coords, containment, urban_rural=None):
+        """Retrieves the top_k nearest toponyms per feature table. If there is a building
+        within 400m, then only the toponyms within 400m are returned, as for the radius
+        search. A containment building counts as a building within 400m."""
+        exclude = set([t.gid for t, _ in containment])
+        toponyms = []
+        for obj in [Polygon, Line, Point]:
+            toponyms.extend(self.nearest_classified(obj, coords, exclude))
+        if urban_rural is None:
+            for toponym, type_ in toponyms:
+                if toponym.distance <= 400 and type_match(type_['type'], ['ARTIFICIAL FEATURE', 'BUILDING']):
+                    urban_rural = 'URBAN'
+                    break
+            for toponym, type_ in containment:
+                if type_match(type_['type'], ['ARTIFICIAL FEATURE', 'BUILDING']):
+                    urban_rural = 'URBAN'
+                    break
+        if urban_rural == 'URBAN':
+            toponyms = [(t, c) for (t, c) in toponyms if t.distance <= 400]
+        return toponyms
+    
+    def __call__(self, point, containment, urban_rural=None):
+        """Retrieves the proximal toponyms for the point (WGS84 lon/lat). The search radius
+        is increased until either a building is found within 400m or more than 10 toponyms
+        are found. If the urban/rural classification is known in advance, then only the
+        400m radius is searched for URBAN points and it is skipped for RURAL points.
+        """
         logging.info('Retrieving proximal toponyms for %.5f,%.5f' % point)
         coords = self.proj(*point)
+        point = make_point(coords)
+        if self.top_k is not None:
+            return self.nearest(coords, containment, urban_rural)
         toponyms = []
-        for dist in [400, 1000, 2000, 3000]:
+        if urban_rural == 'URBAN':
+            distances = [400]
+        elif urban_rural == 'RURAL':
+            distances = [1000, 2000, 3000]
+        else:
+            distances = [400, 1000, 2000, 3000]
+        for dist in distances:
             logging.debug('Querying within %im' % dist)
             toponyms = []
-            for toponym, classification in self.query(self.session.query(Polygon).filter(and_(Polygon.name != '',
-                                                                                              Polygon.way.ST_DWithin(WKTElement('POINT(%f %f)' % coords,
-                                                                                                                                srid=900913),
-                                                                                                                     dist)))):
-                toponyms.append((toponym, classification))
-            for toponym, classification in self.query(self.session.query(Line).filter(and_(Line.name != '',
-                                                                                           Line.way.ST_DWithin(WKTElement('POINT(%f %f)' % coords,
-                                                                                                                          srid=900913),
-                                                                                                               dist)))):
-                toponyms.append((toponym, classification))
-            for toponym, classification in self.query(self.session.query(Point).filter(and_(Point.name != '',
-                                                                                            Point.way.ST_DWithin(WKTElement('POINT(%f %f)' % coords,
-                                                                                                                            srid=900913),
-                                                                                                                 dist)))):
-                toponyms.append((toponym, classification))
+            for obj in [Polygon, Line, Point]:
+                result = self.prepared(obj, 'proximal_%s' % obj.category.lower(), (coords[0], coords[1], dist))
+                if result is None:
+                    result = self.query(obj,
+                                        and_(obj.name != '',
+                                             obj.way.ST_DWithin(point, dist)),
+                                        point=point)
+                toponyms.extend(result)
             if dist == 400:
                 for _, type_ in toponyms:
                     if type_match(type_['type'], ['ARTIFICIAL FEATURE', 'BUILDING']):
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+The instrumentation module records per-stage wall time, SQL statement counts and
+times, and cache hits and misses for the lookup pipeline.
+
+.. moduleauthor:: Mark Hall <mark.hall@mail.room3b.eu>
+"""
+import json
+import logging
+import time
+
+from contextlib import contextmanager
+from sqlalchemy import event
+
+
+class Metrics(object):
+    """The metrics recorded for a single lookup.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.total = None
+        self.stages = {}
+        self.caches = {}
+        self.current = []
+
+    def get_stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'time': 0.0, 'sql_count': 0, 'sql_time': 0.0}
+        return self.stages[name]
+
+    def as_dict(self):
+        return {'total': self.total,
+                'stages': self.stages,
+                'caches': self.caches}
+
+
+class LoggingSink(object):
+    """Metrics sink that logs the metrics of each lookup as JSON.
+    """
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def __call__(self, metrics):
+        logging.log(self.level, 'Lookup metrics: %s' % json.dumps(metrics))
+
+
+class Instrumentation(object):
+    """Records the metrics for the lookups run on the given engine. If not enabled, then
+    all recording methods do nothing. The metrics for each lookup are passed to the sink,
+    which can be any callable that accepts the metrics dictionary.
+    """
+
+    def __init__(self, engine, enabled=False, sink=None):
+        self.enabled = enabled
+        self.sink = sink
+        self.metrics = None
+        if enabled:
+            event.listen(engine, 'before_cursor_execute', self.before_execute)
+            event.listen(engine, 'after_cursor_execute', self.after_execute)
+
+    def start(self):
+        """Start recording the metrics for a new lookup."""
+        if self.enabled:
+            self.metrics = Metrics()
+
+    def finish(self):
+        """Finish recording the current lookup. Passes the metrics to the sink and
+        returns them as a dictionary."""
+        if self.metrics is None:
+            return None
+        metrics = self.metrics
+        self.metrics = None
+        metrics.total = time.perf_counter() - metrics.start
+        metrics = metrics.as_dict()
+        if self.sink is not None:
+            self.sink(metrics)
+        return metrics
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager that records the wall time for the named stage. SQL statements
+        are attributed to the innermost active stage."""
+        if self.metrics is None:
+            yield
+            return
+        metrics = self.metrics
+        metrics.current.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            metrics.get_stage(name)['time'] += time.perf_counter() - start
+            metrics.current.pop()
+
+    def cache(self, table, hit):
+        """Record a hit or miss for the given cache table."""
+        if self.metrics is None:
+            return
+        if table not in self.metrics.caches:
+            self.metrics.caches[table] = {'hit': 0, 'miss': 0}
+        self.metrics.caches[table]['hit' if hit else 'miss'] += 1
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.osmgaz_query_start = time.perf_counter()
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        """Record the statement. The start time is stored on the execution context, so
+        that nothing is left behind if the statement fails."""
+        start = getattr(context, 'osmgaz_query_start', None)
+        if self.metrics is None or start is None:
+            return
+        if self.metrics.current:
+            stage = self.metrics.get_stage(self.metrics.current[-1])
+        else:
+            stage = self.metrics.get_stage('other')
+        stage['sql_count'] += 1
+        stage['sql_time'] += time.perf_counter() - start
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Contains the bulk geocoding functionality. Points are queued in the geocode_job table
+and any number of workers, on any number of machines, claim batches of jobs, run the
+gazetteer pipeline, and store the results in the geocode_result table.
+
+Workers claim batches with ``FOR UPDATE SKIP LOCKED``, so that they never block each
+other. Claimed jobs whose heartbeat is older than the timeout are assumed to have been
+abandoned and are claimed again, up to max_attempts times.
+
+.. moduleauthor:: Mark Hall <mark.hall@mail.room3b.eu>
+"""
+import json
+import logging
+import os
+import socket
+import time
+
+from sqlalchemy import and_, create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from osmgaz.models import GeocodeJob, GeocodeResult
+
+CLAIM_SQL = """UPDATE geocode_job SET status = 'claimed', worker = :worker, heartbeat = now(),
+                                      attempts = attempts + 1
+WHERE id IN (SELECT id FROM geocode_job
+             WHERE (status = 'pending'
+                    OR (status = 'claimed' AND heartbeat < now() - make_interval(secs => :timeout)))
+                   AND attempts < :max_attempts
+             ORDER BY id
+             LIMIT :batch_size
+             FOR UPDATE SKIP LOCKED)
+RETURNING id, lon, lat"""
+
+ABANDON_SQL = """UPDATE geocode_job SET status = 'failed', error = 'Abandoned'
+WHERE status = 'claimed' AND heartbeat < now() - make_interval(secs => :timeout)
+      AND attempts >= :max_attempts"""
+
+HEARTBEAT_SQL = """UPDATE geocode_job SET heartbeat = now()
+WHERE worker = :worker AND status = 'claimed'"""
+
+
+def enqueue(session, points, batch_size=10000):
+    """Add the (lon, lat) points to the job queue."""
+    count = 0
+    batch = []
+    for lon, lat in points:
+        batch.append({'lon': lon, 'lat': lat, 'status': 'pending', 'attempts': 0})
+        if len(batch) >= batch_size:
+            session.execute(GeocodeJob.__table__.insert(), batch)
+            session.commit()
+            count = count + len(batch)
+            batch = []
+    if batch:
+        session.execute(GeocodeJob.__table__.insert(), batch)
+        session.commit()
+        count = count + len(batch)
+    logging.info('Queued %i points' % count)
+    return count
+
+
+class Worker(object):
+    """Claims batches of jobs from the queue and geocodes them using the gazetteer.
+    """
+
+    def __init__(self, gaz, name=None, batch_size=100, timeout=300, max_attempts=3, profile='full'):
+        self.gaz = gaz
+        self.profile = profile
+        self.session = gaz.session
+        self.name = name if name else '%s:%i' % (socket.gethostname(), os.getpid())
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.processed = 0
+        self.failed = 0
+
+    def claim(self):
+        """Claim the next batch of jobs. Returns a list of (id, lon, lat) tuples."""
+        params = {'worker': self.name,
+                  'timeout': self.timeout,
+                  'max_attempts': self.max_attempts,
+                  'batch_size': self.batch_size}
+        self.session.execute(text(ABANDON_SQL), params)
+        jobs = self.session.execute(text(CLAIM_SQL), params).fetchall()
+        self.session.commit()
+        return sorted(jobs)
+
+    def heartbeat(self):
+        """Mark all jobs claimed by this worker as still in progress."""
+        self.session.execute(text(HEARTBEAT_SQL), {'worker': self.name})
+        self.session.commit()
+
+    def owned(self, job_id):
+        """Filter for the job, if it is still claimed by this worker. A job whose heartbeat
+        timed out may have been claimed by another worker in the meantime."""
+        return self.session.query(GeocodeJob).filter(and_(GeocodeJob.id == job_id,
+                                                          GeocodeJob.worker == self.name,
+                                                          GeocodeJob.status == 'claimed'))
+
+    def complete(self, job_id, data):
+        """Store the result, if the job is still claimed by this worker. Returns whether
+        the result was stored."""
+        if self.owned(job_id).update({GeocodeJob.status: 'done',
+                                      GeocodeJob.error: None},
+                                     synchronize_session=False) == 0:
+            logging.warning('Job %i is no longer claimed by %s, discarding the result' % (job_id, self.name))
+            self.session.rollback()
+            return False
+        self.session.add(GeocodeResult(job_id=job_id, data=json.dumps(data)))
+        self.session.commit()
+        return True
+
+    def fail(self, job_id, error, attempts):
+        """Return the job to the queue, or mark it as failed if it has no attempts left.
+        Does nothing if the job is no longer claimed by this worker."""
+        status = 'pending' if attempts < self.max_attempts else 'failed'
+        if self.owned(job_id).update({GeocodeJob.status: status,
+                                      GeocodeJob.worker: None,
+                                      GeocodeJob.error: error},
+                                     synchronize_session=False) == 0:
+            logging.warning('Job %i is no longer claimed by %s' % (job_id, self.name))
+        self.session.commit()
+
+    def process(self, jobs):
+        """Geocode a batch of claimed jobs."""
+        last_heartbeat = time.time()
+        for job_id, lon, lat in jobs:
+            try:
+                if self.complete(job_id, self.gaz((float(lon), float(lat)), self.profile)):
+                    self.processed = self.processed + 1
+            except Exception as e:
+                logging.exception('Geocoding job %i failed' % job_id)
+                self.session.rollback()
+                attempts = self.session.query(GeocodeJob.attempts).filter(GeocodeJob.id == job_id).scalar()
+                self.fail(job_id, str(e), attempts)
+                self.failed = self.failed + 1
+            if time.time() - last_heartbeat > self.timeout / 3:
+                self.heartbeat()
+                last_heartbeat = time.time()
+
+    def __call__(self, wait=False, poll_interval=10):
+        """Process jobs until the queue is empty. If wait is set, then keep polling the
+        queue for new jobs instead."""
+        start = time.time()
+        while True:
+            jobs = self.claim()
+            if not jobs:
+                if not wait:
+                    break
+                time.sleep(poll_interval)
+                continue
+            self.process(jobs)
+            elapsed = time.time() - start
+            logging.info('%s: %i processed, %i failed, %.2f points/s' % (self.name,
+                                                                          self.processed,
+                                                                          self.failed,
+                                                                          self.processed / elapsed if elapsed > 0 else 0))
+
+
+def read_points(filename):
+    """Read the points from a file with one lon,lat pair per line."""
+    with open(filename) as in_f:
+        for line in in_f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                lon, lat = line.split(',')
+                yield (float(lon), float(lat))
+
+
+def run_enqueue(args):
+    """Queues all points from the input file."""
+    logging.root.setLevel(logging.INFO)
+    engine = create_engine(args.sqla_url)
+    session = sessionmaker(bind=engine)()
+    enqueue(session, read_points(args.input))
+
+
+def run_worker(args):
+    """Runs a worker until the queue is empty (or forever, if --wait is set)."""
+    from osmgaz import OSMGaz
+    logging.root.setLevel(logging.INFO)
+    worker = Worker(OSMGaz(args.sqla_url, cache=args.cache, top_k=args.top_k, prepared=args.prepared,
+                           cache_tolerance=args.cache_tolerance),
+                    batch_size=args.batch_size,
+                    profile=args.profile)
+    worker(wait=args.wait)
@@ -3,7 +3,7 @@
 
 .. moduleauthor:: Mark Hall <mark.hall@mail.room3b.eu>
 """
-from sqlalchemy import Column, Integer, Numeric, Unicode, UnicodeText, create_engine, text
+from sqlalchemy import Boolean, Column, DateTime, Integer, Numeric, Unicode, UnicodeText, create_engine, select, text
 from sqlalchemy.dialects.postgresql import HSTORE
 from sqlalchemy.ext.declarative import declarative_base
 from geoalchemy2 import Geometry
@@ -12,6 +12,7 @@ Base = declarative_base()
 
 class Polygon(Base):
     
+    category = 'Polygon'
     __tablename__ = 'planet_osm_polygon'
     
     gid = Column(Integer, primary_key=True)
@@ -26,6 +27,7 @@ class Polygon(Base):
 
 class Line(Base):
     
+    category = 'Line'
     __tablename__ = 'planet_osm_line'
     
     gid = Column(Integer, primary_key=True)
@@ -40,6 +42,7 @@ class Line(Base):
 
 class Point(Base):
     
+    category = 'Point'
     __tablename__ = 'planet_osm_point'
     
     gid = Column(Integer, primary_key=True)
@@ -51,6 +54,75 @@ class Point(Base):
     classification = Column(Unicode(255))
 
 
+CATEGORIES = dict([(obj.__name__, obj) for obj in [Polygon, Line, Point]])
+
+
+class Toponym(object):
+    """Lightweight toponym record returned by the gazetteers. Only holds the columns
+    needed for filtering. The tags are only loaded for toponyms that need classifying
+    and the geometry is only loaded from the source table on first access.
+    """
+    
+    __slots__ = ('category', 'gid', 'osm_id', 'name', 'classification', 'way_area',
+                 'admin_level', 'distance', 'tags', '_way', '_session')
+    
+    def __init__(self, category, gid, osm_id, name, classification=None, way_area=None,
+                 admin_level=None, distance=None, tags=None, way=None, session=None):
+        self.category = category
+        self.gid = gid
+        self.osm_id = osm_id
+        self.name = name
+        self.classification = classification
+        self.way_area = way_area
+        self.admin_level = admin_level
+        self.distance = distance
+        self.tags = tags
+        self._way = way
+        self._session = session
+    
+    @property
+    def way(self):
+        if self._way is None and self._session is not None:
+            obj = CATEGORIES[self.category]
+            self._way = self._session.query(obj.way).filter(obj.gid == self.gid).scalar()
+        return self._way
+    
+    @way.setter
+    def way(self, way):
+        self._way = way
+    
+    def way_clause(self):
+        """Return an SQL expression for the geometry. For toponyms loaded from the database
+        this is a sub-query on the source table, so that the geometry is never transferred.
+        """
+        if self._session is None:
+            return self._way
+        obj = CATEGORIES[self.category]
+        return select([obj.way]).where(obj.gid == self.gid).as_scalar()
+
+
+def way_clause(toponym):
+    """Return an SQL expression for the geometry of either a :class:`Toponym` or a
+    mapped feature."""
+    if isinstance(toponym, Toponym):
+        return toponym.way_clause()
+    return toponym.way
+
+
+def load_geometries(session, toponyms):
+    """Load the geometries for all toponyms that have not yet been loaded, using one
+    query per category."""
+    missing = {}
+    for toponym, _ in toponyms:
+        if isinstance(toponym, Toponym) and toponym._way is None:
+            missing.setdefault(toponym.category, {})[toponym.gid] = toponym
+    for category, batch in missing.items():
+        obj = CATEGORIES[category]
+        for gid, way in session.query(obj.gid, obj.way).filter(obj.gid.in_(list(batch))):
+            batch[gid].way = way
+    return toponyms
+
+
 class NameSalienceCache(Base):
     
     __tablename__ = 'name_salience_cache'
@@ -81,12 +153,80 @@ class FlickrSalienceCache(Base):
     salience = Column(Numeric)
 
 
+class FeatureContainer(Base):
+    
+    __tablename__ = 'feature_container'
+    
+    id = Column(Integer, primary_key=True)
+    category = Column(Unicode(255))
+    toponym_id = Column(Integer, index=True)
+    toponym_name = Column(Unicode)
+    toponym_classification = Column(Unicode(255))
+    container_id = Column(Integer, index=True)
+    container_name = Column(Unicode)
+    container_area = Column(Numeric)
+    container_classification = Column(Unicode(255))
+    selected = Column(Boolean, default=False)
+
+
+class UrbanCell(Base):
+    
+    __tablename__ = 'urban_cell'
+    
+    x = Column(Integer, primary_key=True, autoincrement=False)
+    y = Column(Integer, primary_key=True, autoincrement=False)
+
+
+class PreprocessStatus(Base):
+    """Records which pre-processing stages have been completed."""
+    
+    __tablename__ = 'preprocess_status'
+    
+    stage = Column(Unicode(64), primary_key=True)
+    completed = Column(DateTime(timezone=True))
+
+
 class LookupCache(Base):
     
     __tablename__ = 'lookup_cache'
     
     id = Column(Integer, primary_key=True)
     point = Column(Unicode(255))
+    location = Column(Geometry('POINT', srid=900913))
+    data = Column(UnicodeText)
+
+
+class SpatialLookupCache(Base):
+    
+    __tablename__ = 'spatial_lookup_cache'
+    
+    id = Column(Integer, primary_key=True)
+    point = Column(Geometry('POINT', srid=900913))
+    cell = Column(Geometry(srid=900913))
+    containment = Column(UnicodeText)
+    proximal = Column(UnicodeText)
+
+
+class GeocodeJob(Base):
+    
+    __tablename__ = 'geocode_job'
+    
+    id = Column(Integer, primary_key=True)
+    lon = Column(Numeric)
+    lat = Column(Numeric)
+    status = Column(Unicode(32), default='pending', index=True)
+    worker = Column(Unicode(255))
+    heartbeat = Column(DateTime(timezone=True))
+    attempts = Column(Integer, default=0)
+    error = Column(UnicodeText)
+
+
+class GeocodeResult(Base):
+    
+    __tablename__ = 'geocode_result'
+    
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, index=True)
     data = Column(UnicodeText)
 
 
@@ -107,3 +247,17 @@ def setup_db(args):
             print(e)
     print('Creating cache tables')
     Base.metadata.create_all(engine)
+    MIGRATE_STATEMENTS = ['ALTER TABLE lookup_cache ADD COLUMN IF NOT EXISTS location geometry(Point, 900913)',
+                          'CREATE INDEX IF NOT EXISTS idx_lookup_cache_location ON lookup_cache USING GIST (location)',
+                          """UPDATE lookup_cache
+                             SET location = ST_Transform(ST_SetSRID(ST_MakePoint(split_part(point, '::', 1)::float8,
+                                                                                 split_part(point, '::', 2)::float8),
+                                                                    4326),
+                                                         900913)
+                             WHERE location IS NULL"""]
+    for statement in MIGRATE_STATEMENTS:
+        try:
+            print('Running: %s' % statement)
+            engine.execute(text(statement))
+        except Exception as e:
+            print(e)
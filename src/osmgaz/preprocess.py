@@ -4,17 +4,25 @@ Contains the pre-processing functionality.
 
 .. moduleauthor:: Mark Hall <mark.hall@edgehill.ac.uk>
 """
-import json
 import logging
 import math
 
+from itertools import groupby
 from geoalchemy2 import shape
-from sqlalchemy import and_
+from shapely import geometry
+from shapely.ops import unary_union
+from sqlalchemy import and_, or_, create_engine, exists, func, literal, text
+from sqlalchemy.orm import aliased, sessionmaker
 
-from osmgaz.classifier import NameSalienceCalculator, TypeSalienceCalculator
+from osmgaz.classifier import (NameSalienceCalculator, TypeSalienceCalculator, UrbanRuralClassifier,
+                               URBAN_CELL_SIZE, URBAN_DISTANCE, URBAN_GRID_STAGE, merge_unknown)
 from osmgaz.filters import ContainmentFilter
 from osmgaz.gazetteer import ContainmentGazetteer
-from osmgaz.models import Point, Line, Polygon
+from osmgaz.models import (Point, Line, Polygon, NameSalienceCache, TypeSalienceCache,
+                           LookupCache, SpatialLookupCache, FeatureContainer, UrbanCell, PreprocessStatus, Toponym,
+                           CATEGORIES)
+
+CHANGE_TABLES = {'polygon': Polygon, 'line': Line, 'point': Point}
 
 
 def classify(session, obj, classifier, full):
@@ -28,54 +36,451 @@ def classify(session, obj, classifier, full):
         for toponym in query.offset(start * 1000).limit(1000):
             classification = classifier(toponym)
             if classification:
-                classification = '::'.join(classification)
+                classification = '::'.join(classification['type'])
                 if classification != toponym.classification:
-                    toponym.classification = '::'.join(classification)
+                    toponym.classification = classification
         session.commit()
         logging.info('Classified %i %s' % ((start + 1) * 1000, obj.__name__))
 
 
-def salience(session, obj, gaz, filtr, name_salience, type_salience, full):
-    """Pre-calculate the name and type salience for the location"""
+def feature_salience(toponym, gaz, filtr, name_salience, type_salience):
+    """Calculate the name and type salience for a single toponym, relative to its
+    containment hierarchy."""
+    geom = shape.to_shape(toponym.way)
+    containment = gaz(gaz.proj(geom.centroid.x, geom.centroid.y, inverse=True))
+    containment = [(t, c) for (t, c) in containment if t.name != toponym.name]
+    containment = filtr(containment[:-1])
+    if containment:
+        name_salience(toponym, {'type': toponym.classification.split('::')}, containment)
+        type_salience({'type': toponym.classification.split('::')}, containment)
+
+
+def containment_join(session, obj, batch_size=10000):
+    """Materialise the containment chain for all classified entries of type obj into the
+    feature_container table. Uses a single spatial join of the feature centroids against
+    all classified containers, partitioned into gid ranges of batch_size."""
+    session.query(FeatureContainer).filter(FeatureContainer.category == obj.category).delete(synchronize_session=False)
+    container = aliased(Polygon)
+    max_gid = session.query(func.max(obj.gid)).scalar() or 0
+    for start in range(0, max_gid + 1, batch_size):
+        query = session.query(literal(obj.category),
+                              obj.gid,
+                              obj.name,
+                              obj.classification,
+                              container.gid,
+                              container.name,
+                              container.way_area,
+                              container.classification).\
+            join(container, container.way.ST_Contains(obj.way.ST_Centroid())).\
+            filter(and_(obj.gid >= start,
+                        obj.gid < start + batch_size,
+                        obj.name != '',
+                        obj.classification != None,
+                        container.name != '',
+                        container.classification != None))
+        session.execute(FeatureContainer.__table__.insert().from_select(['category', 'toponym_id', 'toponym_name',
+                                                                         'toponym_classification', 'container_id',
+                                                                         'container_name', 'container_area',
+                                                                         'container_classification'],
+                                                                        query.statement))
+        session.commit()
+        logging.info('Containment calculated for %i %s' % (min(start + batch_size, max_gid), obj.__name__))
+
+
+def select_containers(session, filtr, obj, batch_size=10000):
+    """Select the container against which the salience of each entry of type obj is
+    calculated. As with the per-feature calculation, containers with the same name and
+    the largest container are ignored. Of the :class:`~osmgaz.filters.ContainmentFilter`
+    steps only filter_duplicates can remove the smallest container, so only that is
+    applied."""
+    query = session.query(FeatureContainer.id,
+                          FeatureContainer.toponym_id,
+                          FeatureContainer.toponym_name,
+                          FeatureContainer.container_id,
+                          FeatureContainer.container_name,
+                          FeatureContainer.container_area,
+                          FeatureContainer.container_classification).\
+        filter(FeatureContainer.category == obj.category).\
+        order_by(FeatureContainer.toponym_id, FeatureContainer.container_area).yield_per(batch_size)
+    selected = []
+    count = 0
+    for _, rows in groupby(query, key=lambda row: row[1]):
+        row_ids = {}
+        containment = []
+        for row_id, _, toponym_name, container_id, container_name, container_area, container_classification in rows:
+            if container_name == toponym_name:
+                continue
+            row_ids[container_id] = row_id
+            containment.append((Toponym('Polygon', container_id, None, container_name,
+                                        classification=container_classification,
+                                        way_area=container_area),
+                                {'type': container_classification.split('::')}))
+        containment = filtr.filter_duplicates(containment[:-1])
+        if containment:
+            selected.append(row_ids[containment[0][0].gid])
+        count = count + 1
+    for start in range(0, len(selected), batch_size):
+        session.query(FeatureContainer).filter(FeatureContainer.id.in_(selected[start:start + batch_size])).\
+            update({FeatureContainer.selected: True}, synchronize_session=False)
+        session.commit()
+    logging.info('Containers selected for %i %s' % (count, obj.__name__))
+
+
+def count_clause(condition):
+    """Build the SQL that counts the features in all three tables that match the condition
+    and lie within 400m of the container c."""
+    return ' + '.join(['(SELECT count(*) FROM %s t WHERE %s AND ST_DWithin(t.way, c.way, 400))' % (obj.__tablename__,
+                                                                                                   condition)
+                       for obj in [Point, Line, Polygon]])
+
+
+NAME_SALIENCE_SQL = """WITH pairs AS (
+    SELECT DISTINCT fc.container_id, fc.toponym_name AS name,
+           fc.toponym_classification LIKE 'ARTIFICIAL FEATURE::TRANSPORT::PUBLIC%%' AS public
+    FROM feature_container fc
+    WHERE fc.selected AND fc.container_id >= :start AND fc.container_id < :end
+), counts AS (
+    SELECT pairs.container_id, pairs.name, pairs.public, %s AS total
+    FROM pairs JOIN planet_osm_polygon c ON c.gid = pairs.container_id
+)
+INSERT INTO name_salience_cache (category, toponym_id, container_id, salience)
+SELECT fc.category, fc.toponym_id, fc.container_id,
+       CASE WHEN counts.total > 0 THEN 1.0 / counts.total ELSE 0 END
+FROM feature_container fc
+JOIN counts ON counts.container_id = fc.container_id AND counts.name = fc.toponym_name
+           AND counts.public = (fc.toponym_classification LIKE 'ARTIFICIAL FEATURE::TRANSPORT::PUBLIC%%')
+WHERE fc.selected AND fc.container_id >= :start AND fc.container_id < :end
+      AND NOT EXISTS (SELECT 1 FROM name_salience_cache n
+                      WHERE n.category = fc.category AND n.toponym_id = fc.toponym_id
+                            AND n.container_id = fc.container_id)""" % \
+    count_clause("t.name = pairs.name AND (pairs.public OR NOT t.classification LIKE 'ARTIFICIAL FEATURE::TRANSPORT::PUBLIC%')")
+
+TYPE_SALIENCE_SQL = """WITH pairs AS (
+    SELECT DISTINCT fc.container_id, fc.toponym_classification AS toponym_type
+    FROM feature_container fc
+    WHERE fc.selected AND fc.container_id >= :start AND fc.container_id < :end
+)
+INSERT INTO type_salience_cache (toponym_type, container_id, salience)
+SELECT pairs.toponym_type, pairs.container_id,
+       CASE WHEN counts.total > 0 THEN 1.0 / counts.total ELSE 0 END
+FROM pairs
+JOIN planet_osm_polygon c ON c.gid = pairs.container_id
+CROSS JOIN LATERAL (SELECT %s AS total) counts
+WHERE NOT EXISTS (SELECT 1 FROM type_salience_cache t
+                  WHERE t.toponym_type = pairs.toponym_type AND t.container_id = pairs.container_id)""" % \
+    count_clause("t.classification LIKE pairs.toponym_type || '%'")
+
+
+def salience(session, full, batch_size=1000):
+    """Pre-calculate the name and type salience for all features, driven by the selected
+    containers in the feature_container table. Each batch of containers is calculated
+    in a single statement."""
     if full:
-        query = session.query(obj).filter(obj.name != '').order_by(obj.gid)
-    else:
-        query = session.query(obj).filter(and_(obj.name != '',
-                                               obj.classification != None)).order_by(obj.gid)
-    for start in range(0, math.ceil(query.count() / 1000)):
-        for toponym in query.offset(start * 1000).limit(1000):
-            geom = shape.to_shape(toponym.way)
-            containment = gaz(gaz.proj(geom.centroid.x, geom.centroid.y, inverse=True))
-            containment = [(t, c) for (t, c) in containment if t.name != toponym.name]
-            containment = filtr(containment[:-1])
-            if containment:
-                name_salience(toponym, containment)
-                type_salience({'type': toponym.classification.split('::')}, containment)
-        logging.info('Salience calculated for %i %s' % ((start + 1) * 1000, obj.__name__))
+        session.query(NameSalienceCache).delete(synchronize_session=False)
+        session.query(TypeSalienceCache).delete(synchronize_session=False)
+        session.commit()
+    max_gid = session.query(func.max(FeatureContainer.container_id)).scalar() or 0
+    for start in range(0, max_gid + 1, batch_size):
+        params = {'start': start, 'end': start + batch_size}
+        session.execute(text(NAME_SALIENCE_SQL), params)
+        session.execute(text(TYPE_SALIENCE_SQL), params)
+        session.commit()
+        logging.info('Salience calculated for containers up to %i' % min(start + batch_size, max_gid))
+
+
+URBAN_CELL_SQL = """INSERT INTO urban_cell (x, y)
+SELECT DISTINCT gx.x, gy.y
+FROM %s b
+CROSS JOIN LATERAL generate_series(GREATEST(floor((ST_XMin(b.way) - :distance) / :size)::integer, :xmin),
+                                   LEAST(floor((ST_XMax(b.way) + :distance) / :size)::integer, :xmax)) AS gx(x)
+CROSS JOIN LATERAL generate_series(GREATEST(floor((ST_YMin(b.way) - :distance) / :size)::integer, :ymin),
+                                   LEAST(floor((ST_YMax(b.way) + :distance) / :size)::integer, :ymax)) AS gy(y)
+WHERE b.gid >= :start AND b.gid < :end AND b.name != ''
+      AND b.classification LIKE 'ARTIFICIAL FEATURE::BUILDING%%'
+      AND b.way && ST_MakeEnvelope(:xmin * :size - :distance, :ymin * :size - :distance,
+                                   (:xmax + 1) * :size + :distance, (:ymax + 1) * :size + :distance, 900913)
+      AND ST_DWithin(b.way, ST_SetSRID(ST_MakePoint((gx.x + 0.5) * :size, (gy.y + 0.5) * :size), 900913), :distance)
+ON CONFLICT DO NOTHING"""
+
+WORLD_CELLS = (-1000000, -1000000, 1000000, 1000000)
+
+
+def urban_cells(session, obj, cells=WORLD_CELLS, batch_size=10000):
+    """Mark all grid cells within URBAN_DISTANCE of a building of type obj as urban,
+    limited to the cells (xmin, ymin, xmax, ymax) range."""
+    max_gid = session.query(func.max(obj.gid)).scalar() or 0
+    for start in range(0, max_gid + 1, batch_size):
+        session.execute(text(URBAN_CELL_SQL % obj.__tablename__), {'start': start,
+                                                                   'end': start + batch_size,
+                                                                   'size': URBAN_CELL_SIZE,
+                                                                   'distance': URBAN_DISTANCE,
+                                                                   'xmin': cells[0],
+                                                                   'ymin': cells[1],
+                                                                   'xmax': cells[2],
+                                                                   'ymax': cells[3]})
+        session.commit()
+    logging.info('Urban cells calculated for all %s' % obj.__name__)
+
+
+def build_urban_grid(session):
+    """Build the complete urban cell grid. The grid is only used by the classifier and
+    updated incrementally once the build has been recorded as completed."""
+    session.query(PreprocessStatus).filter(PreprocessStatus.stage == URBAN_GRID_STAGE).delete(synchronize_session=False)
+    session.query(UrbanCell).delete(synchronize_session=False)
+    session.commit()
+    for obj in [Polygon, Line, Point]:
+        logging.info('Urban cell calculation for all %s' % (obj.__name__))
+        urban_cells(session, obj)
+    session.add(PreprocessStatus(stage=URBAN_GRID_STAGE, completed=func.now()))
+    session.commit()
+
+
+def merge_cell_ranges(ranges):
+    """Merge the overlapping or adjacent (xmin, ymin, xmax, ymax) cell ranges into their
+    bounding ranges, until no two ranges overlap."""
+    merged = []
+    for cells in ranges:
+        while True:
+            for idx, other in enumerate(merged):
+                if cells[0] <= other[2] + 1 and other[0] <= cells[2] + 1 and \
+                        cells[1] <= other[3] + 1 and other[1] <= cells[3] + 1:
+                    cells = (min(cells[0], other[0]), min(cells[1], other[1]),
+                             max(cells[2], other[2]), max(cells[3], other[3]))
+                    del merged[idx]
+                    break
+            else:
+                break
+        merged.append(cells)
+    return merged
+
+
+def update_urban_cells(session, areas):
+    """Re-calculate the urban cells around the changed areas (shapely geometries). The
+    cell ranges of nearby areas are merged, so that each merged range is only
+    re-calculated once."""
+    ranges = []
+    for area in areas:
+        bounds = area.bounds
+        ranges.append((int(math.floor((bounds[0] - URBAN_DISTANCE) / URBAN_CELL_SIZE)),
+                       int(math.floor((bounds[1] - URBAN_DISTANCE) / URBAN_CELL_SIZE)),
+                       int(math.floor((bounds[2] + URBAN_DISTANCE) / URBAN_CELL_SIZE)),
+                       int(math.floor((bounds[3] + URBAN_DISTANCE) / URBAN_CELL_SIZE))))
+    ranges = merge_cell_ranges(ranges)
+    max_gids = dict([(obj, session.query(func.max(obj.gid)).scalar() or 0) for obj in [Polygon, Line, Point]])
+    for cells in ranges:
+        session.query(UrbanCell).filter(and_(UrbanCell.x >= cells[0],
+                                             UrbanCell.y >= cells[1],
+                                             UrbanCell.x <= cells[2],
+                                             UrbanCell.y <= cells[3])).delete(synchronize_session=False)
+        for obj in [Polygon, Line, Point]:
+            urban_cells(session, obj, cells=cells, batch_size=max_gids[obj] + 1)
+    logging.info('Urban cells re-calculated for %i cell ranges' % len(ranges))
 
 
 def run(args):
     """Pre-processes the complete data-set"""
     logging.root.setLevel(logging.INFO)
-    gaz = ContainmentGazetteer(args.sqla_url)
+    engine = create_engine(args.sqla_url)
+    session = sessionmaker(bind=engine)()
+    gaz = ContainmentGazetteer(session)
     containment_filter = ContainmentFilter(gaz)
-    session = gaz.session
     classifier = gaz.classifier
-    name_salience = NameSalienceCalculator(args.sqla_url)
-    type_salience = TypeSalienceCalculator(args.sqla_url)
-    for obj in [Polygon, Line, Point]:
-        logging.info('Classifying all %s' % (obj.__name__))
-        classify(session, obj, classifier, args.full)
     with open('unknown.txt', 'w') as out_f:
-        for tags in classifier.get_unknown():
-            out_f.write('%s\n' % json.dumps(tags))
+        classifier.unknown.stream = out_f
+        for obj in [Polygon, Line, Point]:
+            logging.info('Classifying all %s' % (obj.__name__))
+            classify(session, obj, classifier, args.full)
+        classifier.unknown.flush()
+        classifier.unknown.stream = None
+    merge_unknown(['unknown.txt'], 'unknown.txt')
+    build_urban_grid(session)
     for obj in [Polygon, Line, Point]:
-        logging.info('Salience classification for all %s' % (obj.__name__))
-        salience(session,
-                 obj,
-                 gaz,
-                 containment_filter,
-                 name_salience,
-                 type_salience,
-                 args.full)
+        logging.info('Containment calculation for all %s' % (obj.__name__))
+        containment_join(session, obj)
+        select_containers(session, containment_filter, obj)
+    logging.info('Salience calculation')
+    salience(session, args.full)
+
+
+def load_changes(filename):
+    """Load the changed features from a change file. Each line contains the feature
+    table (polygon, line, or point) and the osm_id of the changed feature, optionally
+    followed by the bounding box (xmin ymin xmax ymax, in the database projection) of
+    the feature before the change, all separated by whitespace. The bounding box is
+    needed for deleted and moved features, as the database only contains the current
+    geometries. Returns a dictionary mapping each model class to a dictionary of
+    osm_id to previous bounding box (None if not given).
+    """
+    changes = dict([(obj, {}) for obj in [Polygon, Line, Point]])
+    with open(filename) as in_f:
+        for line in in_f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split()
+            if len(parts) not in [2, 6]:
+                logging.warning('Invalid line "%s" in change file' % line)
+                continue
+            table, osm_id = parts[:2]
+            bounds = tuple([float(v) for v in parts[2:]]) if len(parts) == 6 else None
+            table = table.lower()
+            if table.startswith('planet_osm_'):
+                table = table[len('planet_osm_'):]
+            if table not in CHANGE_TABLES:
+                logging.warning('Unknown table %s in change file' % table)
+                continue
+            osm_ids = changes[CHANGE_TABLES[table]]
+            previous = osm_ids.get(int(osm_id))
+            if previous is not None and bounds is not None:
+                bounds = (min(previous[0], bounds[0]), min(previous[1], bounds[1]),
+                          max(previous[2], bounds[2]), max(previous[3], bounds[3]))
+            osm_ids[int(osm_id)] = bounds if bounds is not None else previous
+    return changes
+
+
+def reclassify(session, obj, osm_ids, classifier):
+    """Re-classify only those entries of type obj that have one of the given osm_ids.
+    Returns all changed toponyms, including those that can no longer be classified."""
+    toponyms = []
+    osm_ids = list(osm_ids)
+    for start in range(0, len(osm_ids), 1000):
+        for toponym in session.query(obj).filter(obj.osm_id.in_(osm_ids[start:start + 1000])):
+            classification = None
+            if toponym.name:
+                classification = classifier(toponym)
+            if classification:
+                toponym.classification = '::'.join(classification['type'])
+            else:
+                toponym.classification = None
+            toponyms.append(toponym)
+        session.commit()
+    logging.info('Re-classified %i %s' % (len(toponyms), obj.__name__))
+    return toponyms
+
+
+def changed_areas(toponyms, bounds):
+    """Return the areas affected by the changes as shapely geometries: the current
+    geometries of the changed toponyms and the previous bounding boxes."""
+    return [shape.to_shape(t.way) for t in toponyms] + [geometry.box(*b) for b in bounds]
 
+
+def missing_features(obj, changes, toponyms):
+    """Log a warning for each changed osm_id of type obj that is not in the database and
+    has no previous bounding box, as the area around it cannot be updated."""
+    found = set([t.osm_id for t in toponyms])
+    missing = 0
+    for osm_id, bounds in changes.items():
+        if osm_id not in found and bounds is None:
+            logging.warning('%s %i not found and no previous bounding box given, the salience and cached lookups around it are not updated' % (obj.__name__, osm_id))
+            missing = missing + 1
+    return missing
+
+
+def affected_containers(session, areas, distance=400):
+    """Find the gids of all containers whose salience buffer touches any of the areas."""
+    gids = set()
+    for area in areas:
+        for (gid,) in session.query(Polygon.gid).filter(and_(Polygon.name != '',
+                                                             Polygon.way.ST_DWithin(shape.from_shape(area, srid=900913),
+                                                                                    distance))):
+            gids.add(gid)
+    return gids
+
+
+def refresh_salience(session, container_ids, name_salience, type_salience):
+    """Remove and re-calculate all cached name and type salience values for the given
+    containers."""
+    container_ids = list(container_ids)
+    for start in range(0, len(container_ids), 1000):
+        batch = container_ids[start:start + 1000]
+        name_entries = session.query(NameSalienceCache.category,
+                                     NameSalienceCache.toponym_id,
+                                     NameSalienceCache.container_id).filter(NameSalienceCache.container_id.in_(batch)).all()
+        type_entries = session.query(TypeSalienceCache.toponym_type,
+                                     TypeSalienceCache.container_id).filter(TypeSalienceCache.container_id.in_(batch)).all()
+        session.query(NameSalienceCache).filter(NameSalienceCache.container_id.in_(batch)).delete(synchronize_session=False)
+        session.query(TypeSalienceCache).filter(TypeSalienceCache.container_id.in_(batch)).delete(synchronize_session=False)
+        session.commit()
+        containers = dict([(c.gid, c) for c in session.query(Polygon).filter(Polygon.gid.in_(batch))])
+        for category, toponym_id, container_id in name_entries:
+            if category not in CATEGORIES or container_id not in containers:
+                continue
+            obj = CATEGORIES[category]
+            toponym = session.query(obj).filter(obj.gid == toponym_id).first()
+            if toponym and toponym.classification:
+                name_salience(toponym,
+                              {'type': toponym.classification.split('::')},
+                              [(containers[container_id], None)])
+        for toponym_type, container_id in type_entries:
+            if container_id in containers:
+                type_salience({'type': toponym_type.split('::')}, [(containers[container_id], None)])
+    logging.info('Salience re-calculated for %i containers' % len(container_ids))
+
+
+def invalidate_lookup_cache(session, areas, container_ids=(), distance=3000):
+    """Remove all cached lookups that lie within distance of any of the areas or within
+    any of the containers whose salience was re-calculated. The default distance matches
+    the largest proximal search radius. Returns the number of removed lookups."""
+    removed = 0
+    if areas:
+        changed = shape.from_shape(unary_union(areas), srid=900913)
+        removed = removed + session.query(LookupCache).filter(LookupCache.location.ST_DWithin(changed, distance)).\
+            delete(synchronize_session=False)
+        removed = removed + session.query(SpatialLookupCache).filter(or_(SpatialLookupCache.point.ST_DWithin(changed, distance),
+                                                                         SpatialLookupCache.cell.ST_Intersects(changed))).\
+            delete(synchronize_session=False)
+    container_ids = list(container_ids)
+    for start in range(0, len(container_ids), 1000):
+        batch = container_ids[start:start + 1000]
+        for obj in [LookupCache, SpatialLookupCache]:
+            location = obj.location if obj is LookupCache else obj.point
+            removed = removed + session.query(obj).filter(exists().where(and_(Polygon.gid.in_(batch),
+                                                                              Polygon.way.ST_Contains(location)))).\
+                delete(synchronize_session=False)
+    session.commit()
+    logging.info('Removed %i cached lookups' % removed)
+    return removed
+
+
+def update(args):
+    """Incrementally updates the data-set for the features listed in the change file.
+    Only the changed features are re-classified, only the salience values for containers
+    near the changed features are re-calculated, and only the cached lookups near the
+    changed features or within the re-calculated containers are removed. Deleted and
+    moved features are only handled if the change file contains their previous bounding
+    box.
+    """
+    logging.root.setLevel(logging.INFO)
+    engine = create_engine(args.sqla_url)
+    session = sessionmaker(bind=engine)()
+    gaz = ContainmentGazetteer(session)
+    containment_filter = ContainmentFilter(gaz)
+    classifier = gaz.classifier
+    name_salience = NameSalienceCalculator(session)
+    type_salience = TypeSalienceCalculator(session)
+    changes = load_changes(args.changes)
+    toponyms = []
+    with open('unknown.txt', 'a') as out_f:
+        classifier.unknown.stream = out_f
+        for obj in [Polygon, Line, Point]:
+            changed = reclassify(session, obj, changes[obj], classifier)
+            missing_features(obj, changes[obj], changed)
+            toponyms.extend(changed)
+        classifier.unknown.flush()
+        classifier.unknown.stream = None
+    merge_unknown(['unknown.txt'], 'unknown.txt')
+    areas = changed_areas(toponyms, [bounds for obj in [Polygon, Line, Point]
+                                     for bounds in changes[obj].values() if bounds is not None])
+    container_ids = affected_containers(session, areas)
+    refresh_salience(session,
+                     container_ids,
+                     name_salience,
+                     type_salience)
+    for toponym in toponyms:
+        if toponym.name and toponym.classification:
+            feature_salience(toponym, gaz, containment_filter, name_salience, type_salience)
+    if UrbanRuralClassifier(session).has_grid():
+        update_urban_cells(session, areas)
+    else:
+        logging.info('No complete urban cell grid, skipping the urban cell update')
+    invalidate_lookup_cache(session, areas, container_ids)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Server-side prepared statements for the hot lookup queries. The statements use bound
+numeric parameters for the point and are prepared once per database connection, so
+neither the query building in Python nor the query planning in the database has to be
+repeated for each lookup. To be effective, the engine must use a connection pool.
+
+.. moduleauthor:: Mark Hall <mark.hall@mail.room3b.eu>
+"""
+from sqlalchemy import text
+
+PUBLIC_TRANSPORT = 'ARTIFICIAL FEATURE::TRANSPORT::PUBLIC'
+TABLES = {'Polygon': 'planet_osm_polygon', 'Line': 'planet_osm_line', 'Point': 'planet_osm_point'}
+POINT = 'ST_SetSRID(ST_MakePoint($1, $2), 900913)'
+
+
+def toponym_columns(category):
+    """The columns loaded for a toponym, in the order expected by the gazetteer."""
+    if category == 'Polygon':
+        return "gid, osm_id, name, classification, way_area, tags -> 'admin_level'"
+    return 'gid, osm_id, name, classification'
+
+
+def count_clause(condition):
+    """Sum of the features in all three tables that match the condition and lie within
+    400m of the container c."""
+    return ' + '.join(['(SELECT count(*) FROM %s t WHERE %s AND ST_DWithin(t.way, c.way, 400))' % (table, condition)
+                       for table in ['planet_osm_point', 'planet_osm_line', 'planet_osm_polygon']])
+
+
+STATEMENTS = {'containment': ('float8, float8',
+                              "SELECT %s FROM planet_osm_polygon WHERE name != '' AND ST_Contains(way, %s)" % (toponym_columns('Polygon'),
+                                                                                                            POINT)),
+              'unique': ('text, integer',
+                         """SELECT %s FROM planet_osm_polygon
+                            WHERE name = $1 AND ST_Intersects(way, (SELECT way FROM planet_osm_polygon WHERE gid = $2))""" % toponym_columns('Polygon')),
+              'name_salience_cache': ('text, integer, integer',
+                                      """SELECT salience FROM name_salience_cache
+                                         WHERE category = $1 AND toponym_id = $2 AND container_id = $3 LIMIT 1"""),
+              'type_salience_cache': ('text, integer',
+                                      """SELECT salience FROM type_salience_cache
+                                         WHERE toponym_type = $1 AND container_id = $2 LIMIT 1"""),
+              'name_count': ('text, integer',
+                             'SELECT %s FROM planet_osm_polygon c WHERE c.gid = $2' % count_clause('t.name = $1')),
+              'name_count_other': ('text, integer',
+                                   'SELECT %s FROM planet_osm_polygon c WHERE c.gid = $2' % count_clause("t.name = $1 AND NOT left(t.classification, %i) = '%s'" % (len(PUBLIC_TRANSPORT),
+                                                                                                                                                                   PUBLIC_TRANSPORT))),
+              'type_count': ('text, integer',
+                             'SELECT %s FROM planet_osm_polygon c WHERE c.gid = $2' % count_clause('left(t.classification, length($1)) = $1'))}
+for category, table in TABLES.items():
+    STATEMENTS['proximal_%s' % category.lower()] = ('float8, float8, float8',
+                                                    """SELECT %s, ST_Distance(way, %s) FROM %s
+                                                       WHERE name != '' AND ST_DWithin(way, %s, $3)""" % (toponym_columns(category),
+                                                                                                          POINT,
+                                                                                                          table,
+                                                                                                          POINT))
+    if category == 'Polygon':
+        types = 'float8, float8, float8, integer, integer, integer[]'
+        containment = 'AND NOT ST_Contains(way, %s) AND gid <> ALL($6)' % POINT
+    else:
+        types = 'float8, float8, float8, integer, integer'
+        containment = ''
+    STATEMENTS['nearest_%s' % category.lower()] = (types,
+                                                   """SELECT %s, ST_Distance(way, %s) FROM %s
+                                                      WHERE name != '' AND ST_DWithin(way, %s, $3) %s
+                                                      ORDER BY way <-> %s LIMIT $4 OFFSET $5""" % (toponym_columns(category),
+                                                                                                   POINT,
+                                                                                                   table,
+                                                                                                   POINT,
+                                                                                                   containment,
+                                                                                                   POINT))
+
+
+class PreparedStatements(object):
+    """Executes the named statements as server-side prepared statements. Each statement
+    is prepared on the first use on each database connection.
+    """
+
+    def execute(self, session, name, params):
+        """Execute the named statement with the positional params and return all rows."""
+        connection = session.connection()
+        prepared = connection.info.setdefault('osmgaz_prepared', set())
+        if name not in prepared:
+            types, sql = STATEMENTS[name]
+            connection.execute(text('PREPARE osmgaz_%s (%s) AS %s' % (name, types, sql)))
+            prepared.add(name)
+        placeholders = ', '.join([':p%i' % idx for idx in range(0, len(params))])
+        return connection.execute(text('EXECUTE osmgaz_%s (%s)' % (name, placeholders)),
+                                  dict([('p%i' % idx, value) for idx, value in enumerate(params)])).fetchall()
+
+    def scalar(self, session, name, params):
+        """Execute the named statement and return the first column of the first row."""
+        rows = self.execute(session, name, params)
+        if rows:
+            return rows[0][0]
+        return None
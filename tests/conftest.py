@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+The database tests run against the synthetic data-set from :mod:`osmgaz.benchmark`.
+Set OSMGAZ_TEST_DB to the SQLAlchemy URL of an empty PostGIS database to run them.
+The OSM tables in that database are dropped and re-created.
+"""
+import os
+import pytest
+
+
+@pytest.fixture(scope='session')
+def sqla_url():
+    """Returns the URL of the test database with the synthetic data-set loaded."""
+    url = os.environ.get('OSMGAZ_TEST_DB')
+    if not url:
+        pytest.skip('OSMGAZ_TEST_DB is not set')
+    from sqlalchemy import create_engine
+    from osmgaz.benchmark import generate
+    generate(create_engine(url))
+    return url
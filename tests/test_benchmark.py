@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from sqlalchemy import create_engine, text
+
+from osmgaz.benchmark import MARKER_TABLE, generate, is_benchmark_dataset
+
+
+def test_generated_dataset_is_marked(sqla_url):
+    assert is_benchmark_dataset(create_engine(sqla_url))
+
+
+def test_generate_refuses_to_replace_osm_tables(sqla_url):
+    """Without the marker table, the OSM tables are assumed to be a real import."""
+    engine = create_engine(sqla_url)
+    engine.execute(text('ALTER TABLE %s RENAME TO %s_hidden' % (MARKER_TABLE, MARKER_TABLE)))
+    try:
+        assert not is_benchmark_dataset(engine)
+        with pytest.raises(ValueError):
+            generate(engine)
+    finally:
+        engine.execute(text('ALTER TABLE %s_hidden RENAME TO %s' % (MARKER_TABLE, MARKER_TABLE)))
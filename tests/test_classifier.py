@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import json
+
+from io import StringIO
+
+from osmgaz.classifier import UnknownTags, merge_unknown, unknown_signature
+
+
+def test_signature_ignores_irrelevant_tags():
+    signature = unknown_signature({'amenity': 'fountain',
+                                   'name': 'Old Fountain',
+                                   'addr:street': 'High Street',
+                                   'wheelchair': 'yes'})
+    assert signature == ((('amenity', 'fountain'),), None)
+
+
+def test_signature_is_order_independent():
+    assert unknown_signature({'a': '1', 'b': '2'}) == unknown_signature({'b': '2', 'a': '1'})
+
+
+def test_signature_excludes_matched_tags():
+    signature = unknown_signature({'amenity': 'pub', 'brewery': 'Synthetic'}, {'amenity': 'pub'})
+    assert signature == ((('brewery', 'Synthetic'),), (('amenity', 'pub'),))
+
+
+def test_size_cap_drops_new_signatures():
+    unknown = UnknownTags(max_size=2)
+    assert unknown.add('a')
+    assert unknown.add('b')
+    assert not unknown.add('c')
+    assert not unknown.add('a')
+    assert unknown.counts == {'a': 2, 'b': 1}
+    assert unknown.dropped == 1
+
+
+def test_size_cap_flushes_to_stream():
+    stream = StringIO()
+    unknown = UnknownTags(max_size=1, stream=stream)
+    unknown.add(((('amenity', 'fountain'),), None))
+    unknown.add(((('amenity', 'bench'),), None))
+    assert json.loads(stream.getvalue()) == {'tags': {'amenity': 'fountain'}, 'count': 1}
+    assert len(unknown.counts) == 1
+    assert unknown.dropped == 0
+
+
+def test_interval_flushes_to_stream():
+    stream = StringIO()
+    unknown = UnknownTags(stream=stream, flush_interval=0)
+    unknown.add(((('amenity', 'fountain'),), None))
+    unknown.add(((('amenity', 'fountain'),), None))
+    assert json.loads(stream.getvalue()) == {'tags': {'amenity': 'fountain'}, 'count': 1}
+
+
+def test_merge():
+    first = UnknownTags()
+    first.add('a', 2)
+    first.dropped = 1
+    second = UnknownTags()
+    second.add('a')
+    second.add('b')
+    second.dropped = 2
+    first.merge(second)
+    assert first.counts == {'a': 3, 'b': 1}
+    assert first.dropped == 3
+
+
+def test_merge_unknown_files(tmp_path):
+    """Partial counts from several flushes and files are combined into one line each."""
+    signature = unknown_signature({'brewery': 'Synthetic', 'amenity': 'pub'}, {'amenity': 'pub'})
+    for name, count in [('a.txt', 2), ('b.txt', 3)]:
+        with open(str(tmp_path / name), 'w') as out_f:
+            unknown = UnknownTags(stream=out_f)
+            unknown.add(signature, count)
+            unknown.flush()
+            unknown.add(signature)
+            unknown.flush()
+    output = str(tmp_path / 'a.txt')
+    assert merge_unknown([str(tmp_path / 'a.txt'), str(tmp_path / 'b.txt')], output) == 1
+    with open(output) as in_f:
+        lines = [json.loads(line) for line in in_f]
+    assert lines == [{'tags': {'brewery': 'Synthetic'}, 'match_tags': {'amenity': 'pub'}, 'count': 7}]
+
+
+def test_merge_unknown_in_chunks(tmp_path):
+    """With a chunk size of one signature, every signature is merged from the chunks."""
+    filename = str(tmp_path / 'unknown.txt')
+    with open(filename, 'w') as out_f:
+        unknown = UnknownTags(max_size=1, stream=out_f)
+        for value in ['b', 'a', 'b', 'c', 'a', 'b']:
+            unknown.add(unknown_signature({'amenity': value}))
+        unknown.flush()
+    assert merge_unknown([filename], filename, chunk_size=1) == 3
+    with open(filename) as in_f:
+        lines = [json.loads(line) for line in in_f]
+    assert lines == [{'tags': {'amenity': 'a'}, 'count': 2},
+                     {'tags': {'amenity': 'b'}, 'count': 3},
+                     {'tags': {'amenity': 'c'}, 'count': 1}]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from osmgaz.benchmark import BLOCK_SIZE, ORIGIN
+
+
+def town_centre_point(gaz, grid=30):
+    """Returns the centre of the building in the middle of the synthetic town."""
+    ox, oy = gaz.proj(*ORIGIN)
+    town = grid * BLOCK_SIZE / 2
+    idx = grid // 2 - 1
+    return gaz.proj(ox + idx * BLOCK_SIZE - town + 50, oy + idx * BLOCK_SIZE - town + 50, inverse=True)
+
+
+@pytest.mark.parametrize('prepared', [False, True])
+def test_nearest_skips_containment(sqla_url, prepared):
+    """A dense urban point is contained by several polygons at distance 0. These must not
+    take up the top-k polygon slots."""
+    from osmgaz import OSMGaz
+    gaz = OSMGaz(sqla_url, top_k=3, prepared=prepared)
+    point = town_centre_point(gaz.proximal_gaz)
+    containment = gaz.containment_gaz(point)
+    assert len(containment) >= 4
+    polygons = [t for t, _ in gaz.proximal_gaz(point, containment) if t.category == 'Polygon']
+    assert len(polygons) == 3
+    container_gids = set([t.gid for t, _ in containment])
+    for toponym in polygons:
+        assert toponym.gid not in container_gids
+        assert toponym.distance > 0
+
+
+def test_containment_cell_is_clipped(sqla_url):
+    """The spatial cache cell only covers the area around the point."""
+    from sqlalchemy import func
+    from osmgaz import OSMGaz
+    from osmgaz.gazetteer import make_point
+    gaz = OSMGaz(sqla_url, cache='spatial', cache_cell_size=500)
+    point = town_centre_point(gaz.containment_gaz)
+    coords = gaz.containment_gaz.proj(*point)
+    cell = gaz.containment_cell(make_point(coords), gaz.containment_gaz(point))
+    assert gaz.session.query(func.ST_Area(cell)).scalar() <= 500 * 500
+    assert gaz.session.query(func.ST_Covers(cell, make_point(coords))).scalar()
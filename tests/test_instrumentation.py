@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from osmgaz.instrumentation import Instrumentation
+
+
+@pytest.fixture
+def engine():
+    return create_engine('sqlite://')
+
+
+def test_disabled(engine):
+    instrumentation = Instrumentation(engine)
+    instrumentation.start()
+    with instrumentation.stage('containment'):
+        engine.execute(text('SELECT 1'))
+    instrumentation.cache('lookup_cache', True)
+    assert instrumentation.finish() is None
+
+
+def test_sql_is_attributed_to_innermost_stage(engine):
+    instrumentation = Instrumentation(engine, enabled=True)
+    instrumentation.start()
+    with instrumentation.stage('proximal'):
+        engine.execute(text('SELECT 1'))
+        with instrumentation.stage('geometry'):
+            engine.execute(text('SELECT 1'))
+            engine.execute(text('SELECT 1'))
+    engine.execute(text('SELECT 1'))
+    metrics = instrumentation.finish()
+    assert metrics['stages']['proximal']['sql_count'] == 1
+    assert metrics['stages']['geometry']['sql_count'] == 2
+    assert metrics['stages']['other']['sql_count'] == 1
+    assert metrics['stages']['proximal']['time'] >= metrics['stages']['geometry']['time']
+    assert metrics['total'] >= metrics['stages']['proximal']['time']
+
+
+def test_stage_time_accumulates(engine):
+    instrumentation = Instrumentation(engine, enabled=True)
+    instrumentation.start()
+    for _ in range(0, 2):
+        with instrumentation.stage('salience'):
+            engine.execute(text('SELECT 1'))
+    assert instrumentation.finish()['stages']['salience']['sql_count'] == 2
+
+
+def test_cache_hits_and_misses(engine):
+    instrumentation = Instrumentation(engine, enabled=True)
+    instrumentation.start()
+    instrumentation.cache('lookup_cache', False)
+    instrumentation.cache('name_salience_cache', True)
+    instrumentation.cache('name_salience_cache', True)
+    instrumentation.cache('name_salience_cache', False)
+    assert instrumentation.finish()['caches'] == {'lookup_cache': {'hit': 0, 'miss': 1},
+                                                  'name_salience_cache': {'hit': 2, 'miss': 1}}
+
+
+def test_sink_receives_metrics(engine):
+    received = []
+    instrumentation = Instrumentation(engine, enabled=True, sink=received.append)
+    instrumentation.start()
+    metrics = instrumentation.finish()
+    assert received == [metrics]
+    assert instrumentation.finish() is None
+    assert len(received) == 1
+
+
+def test_failed_statement(engine):
+    """A failing statement is not recorded and does not affect the following ones."""
+    instrumentation = Instrumentation(engine, enabled=True)
+    instrumentation.start()
+    with instrumentation.stage('containment'):
+        with pytest.raises(OperationalError):
+            engine.execute(text('SELECT * FROM missing_table'))
+        engine.execute(text('SELECT 1'))
+    assert instrumentation.finish()['stages']['containment']['sql_count'] == 1
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from osmgaz.jobs import Worker, enqueue
+from osmgaz.models import GeocodeJob, GeocodeResult
+
+
+class FakeGaz(object):
+    """Returns a fixed result, or raises an error if failing is set."""
+
+    def __init__(self, session, failing=False):
+        self.session = session
+        self.failing = failing
+
+    def __call__(self, point, profile='full'):
+        if self.failing:
+            raise ValueError('Lookup failed')
+        return {'osm_containment': [], 'osm_proximal': []}
+
+
+@pytest.fixture
+def session_factory(sqla_url):
+    """Returns a session factory for a database with two queued jobs."""
+    Session = sessionmaker(bind=create_engine(sqla_url))
+    session = Session()
+    session.query(GeocodeResult).delete(synchronize_session=False)
+    session.query(GeocodeJob).delete(synchronize_session=False)
+    session.commit()
+    enqueue(session, [(-2.6, 53.4), (-2.5, 53.5)])
+    session.close()
+    return Session
+
+
+def worker(Session, name, failing=False, max_attempts=3):
+    return Worker(FakeGaz(Session(), failing), name=name, batch_size=10, timeout=60, max_attempts=max_attempts)
+
+
+def abandon(Session):
+    """Move the heartbeat of all claimed jobs past the timeout."""
+    session = Session()
+    session.execute(text("UPDATE geocode_job SET heartbeat = now() - interval '1 hour' WHERE status = 'claimed'"))
+    session.commit()
+    session.close()
+
+
+def test_claimed_jobs_are_not_claimed_again(session_factory):
+    assert len(worker(session_factory, 'a').claim()) == 2
+    assert worker(session_factory, 'b').claim() == []
+
+
+def test_abandoned_jobs_are_reclaimed(session_factory):
+    first = worker(session_factory, 'a')
+    jobs = first.claim()
+    abandon(session_factory)
+    second = worker(session_factory, 'b')
+    assert second.claim() == jobs
+    session = session_factory()
+    assert [(j.worker, j.attempts) for j in session.query(GeocodeJob)] == [('b', 2), ('b', 2)]
+
+
+def test_late_result_is_discarded(session_factory):
+    first = worker(session_factory, 'a')
+    jobs = first.claim()
+    abandon(session_factory)
+    second = worker(session_factory, 'b')
+    second.claim()
+    first.process(jobs)
+    assert first.processed == 0
+    session = session_factory()
+    assert session.query(GeocodeResult).count() == 0
+    assert set([(j.status, j.worker) for j in session.query(GeocodeJob)]) == set([('claimed', 'b')])
+    second.process(jobs)
+    assert second.processed == 2
+    assert session.query(GeocodeResult).count() == 2
+    session.expire_all()
+    assert set([j.status for j in session.query(GeocodeJob)]) == set(['done'])
+
+
+def test_late_failure_is_ignored(session_factory):
+    first = worker(session_factory, 'a', failing=True)
+    jobs = first.claim()
+    abandon(session_factory)
+    worker(session_factory, 'b').claim()
+    first.process(jobs)
+    session = session_factory()
+    assert set([(j.status, j.worker, j.error) for j in session.query(GeocodeJob)]) == set([('claimed', 'b', None)])
+
+
+def test_failed_once_attempts_are_exhausted(session_factory):
+    first = worker(session_factory, 'a', failing=True, max_attempts=2)
+    first.process(first.claim())
+    session = session_factory()
+    assert set([j.status for j in session.query(GeocodeJob)]) == set(['pending'])
+    second = worker(session_factory, 'b', failing=True, max_attempts=2)
+    second.process(second.claim())
+    session.expire_all()
+    assert set([(j.status, j.attempts) for j in session.query(GeocodeJob)]) == set([('failed', 2)])
+    assert worker(session_factory, 'c', max_attempts=2).claim() == []
+
+
+def test_abandoned_jobs_fail_once_attempts_are_exhausted(session_factory):
+    for name in ['a', 'b']:
+        worker(session_factory, name, max_attempts=2).claim()
+        abandon(session_factory)
+    assert worker(session_factory, 'c', max_attempts=2).claim() == []
+    session = session_factory()
+    assert set([(j.status, j.error) for j in session.query(GeocodeJob)]) == set([('failed', 'Abandoned')])
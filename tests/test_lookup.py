@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from osmgaz import OSMGaz, PROFILES, cache_key
+from osmgaz.instrumentation import Instrumentation
+
+POINT = (-2.6, 53.4)
+
+
+class FakeGaz(OSMGaz):
+    """Runs the OSMGaz lookup logic with the database stages replaced by fixed results."""
+
+    def __init__(self, cache='point'):
+        self.instrumentation = Instrumentation(None)
+        self.callback = None
+        self.cache = cache
+        self.stored = {}
+        self.stages = []
+
+    def load(self, point, profile='full'):
+        return self.stored.get(cache_key(point, profile))
+
+    def save(self, point, data, profile='full'):
+        self.stored[cache_key(point, profile)] = data
+
+    def load_spatial(self, point):
+        return None, False
+
+    def save_spatial(self, point, containment, filtered_containment, urban_rural, data, cell=None):
+        self.stored['spatial'] = data
+
+    def find_containment(self, point):
+        self.stages.append('containment')
+        return [('Parish', None), ('County', None)], [('Parish', None)]
+
+    def find_proximal(self, point, containment, filtered_containment):
+        self.stages.append('proximal')
+        return [('Red Lion', None)], 'URBAN'
+
+    def format_topo(self, toponym, classification):
+        return toponym
+
+    def format_containment(self, filtered_containment, urban_rural):
+        return ['%s (salience)' % t for (t, _) in filtered_containment]
+
+    def format_proximal(self, filtered_proximal, filtered_containment, urban_rural):
+        return ['%s (salience)' % t for (t, _) in filtered_proximal]
+
+
+def test_cache_key_full_profile_is_unchanged():
+    assert cache_key(POINT) == '-2.60000::53.40000'
+    assert cache_key(POINT, 'full') == cache_key(POINT)
+
+
+def test_cache_keys_differ_per_profile():
+    keys = set([cache_key(POINT, profile) for profile in PROFILES])
+    assert len(keys) == len(PROFILES)
+    assert cache_key(POINT, 'proximal') == '-2.60000::53.40000::proximal'
+
+
+def test_progressive_containment():
+    gaz = FakeGaz()
+    assert list(gaz.progressive(POINT, 'containment')) == [{'osm_containment': ['Parish']}]
+    assert gaz.stages == ['containment']
+
+
+def test_progressive_proximal():
+    gaz = FakeGaz()
+    assert list(gaz.progressive(POINT, 'proximal')) == [{'osm_containment': ['Parish']},
+                                                        {'osm_containment': ['Parish'],
+                                                         'osm_proximal': ['Red Lion']}]
+    assert gaz.stages == ['containment', 'proximal']
+
+
+@pytest.mark.parametrize('cache', ['point', 'spatial'])
+def test_progressive_full(cache):
+    gaz = FakeGaz(cache)
+    results = list(gaz.progressive(POINT))
+    assert results == [{'osm_containment': ['Parish']},
+                       {'osm_containment': ['Parish'],
+                        'osm_proximal': ['Red Lion']},
+                       {'osm_containment': ['Parish (salience)'],
+                        'osm_proximal': ['Red Lion (salience)']}]
+    assert results[-1] == FakeGaz(cache).lookup(POINT)
+    assert list(gaz.stored.values()) == [results[-1]]
+
+
+def test_progressive_cached():
+    gaz = FakeGaz()
+    list(gaz.progressive(POINT, 'proximal'))
+    gaz.stages = []
+    assert list(gaz.progressive(POINT, 'proximal')) == [{'osm_containment': ['Parish'],
+                                                        'osm_proximal': ['Red Lion']}]
+    assert gaz.stages == []
+
+
+def test_profiles_are_cached_separately():
+    gaz = FakeGaz()
+    gaz.lookup(POINT, 'containment')
+    assert gaz.lookup(POINT, 'proximal') == {'osm_containment': ['Parish'],
+                                             'osm_proximal': ['Red Lion']}
+    assert gaz.stages == ['containment', 'containment', 'proximal']
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from osmgaz.preprocess import merge_cell_ranges
+
+
+def test_merge_overlapping_ranges():
+    assert merge_cell_ranges([(0, 0, 10, 10), (5, 5, 15, 15)]) == [(0, 0, 15, 15)]
+
+
+def test_merge_adjacent_ranges():
+    assert merge_cell_ranges([(0, 0, 10, 10), (11, 0, 20, 10)]) == [(0, 0, 20, 10)]
+
+
+def test_separate_ranges_are_kept():
+    assert merge_cell_ranges([(0, 0, 10, 10), (20, 20, 30, 30)]) == [(0, 0, 10, 10), (20, 20, 30, 30)]
+
+
+def test_merge_is_transitive():
+    """A range that bridges two separate ranges merges all three."""
+    assert merge_cell_ranges([(0, 0, 10, 10), (20, 0, 30, 10), (8, 0, 22, 10)]) == [(0, 0, 30, 10)]
+
+
+def test_urban_grid_is_only_used_once_completed(sqla_url):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from osmgaz.classifier import UrbanRuralClassifier
+    from osmgaz.models import PreprocessStatus, UrbanCell
+    from osmgaz.preprocess import build_urban_grid
+    session = sessionmaker(bind=create_engine(sqla_url))()
+    session.query(PreprocessStatus).delete(synchronize_session=False)
+    session.query(UrbanCell).delete(synchronize_session=False)
+    session.add(UrbanCell(x=0, y=0))
+    session.commit()
+    assert not UrbanRuralClassifier(session).has_grid()
+    build_urban_grid(session)
+    assert UrbanRuralClassifier(session).has_grid()
+
+
+def test_invalidate_lookup_cache(sqla_url):
+    """Lookups near the change and within the re-calculated containers are removed."""
+    from pyproj import Proj
+    from shapely import geometry
+    from sqlalchemy import and_, create_engine
+    from sqlalchemy.orm import sessionmaker
+    from osmgaz.benchmark import ORIGIN
+    from osmgaz.gazetteer import make_point
+    from osmgaz.models import LookupCache, Polygon
+    from osmgaz.preprocess import invalidate_lookup_cache
+    session = sessionmaker(bind=create_engine(sqla_url))()
+    ox, oy = Proj('+init=EPSG:3857')(*ORIGIN)
+    session.query(LookupCache).delete(synchronize_session=False)
+    for name, x, y in [('near', ox + 1500, oy + 1500),
+                       ('container', ox + 8000, oy + 8000),
+                       ('outside', ox - 8000, oy - 8000)]:
+        session.add(LookupCache(point=name, location=make_point((x, y)), data='{}'))
+    session.commit()
+    parish = session.query(Polygon.gid).filter(and_(Polygon.name.like('Parish %'),
+                                                    Polygon.way.ST_Contains(make_point((ox + 1500, oy + 1500))))).scalar()
+    removed = invalidate_lookup_cache(session, [geometry.box(ox + 900, oy + 900, ox + 1100, oy + 1100)], [parish])
+    assert removed == 2
+    assert [point for (point,) in session.query(LookupCache.point)] == ['outside']